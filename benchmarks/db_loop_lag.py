@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""Compare the event loop lag while consumers query SQLite through a sync and an async session.
+
+Run from the repository root: python -m benchmarks.db_loop_lag
+"""
+
+import asyncio
+import datetime
+import os
+import statistics
+import tempfile
+import time
+
+from sqlalchemy import create_engine, select, update
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import Session, joinedload
+
+from wallabag_kindle_consumer.models import Base, Job, User
+
+USERS = 50
+JOBS = 2000
+TASKS = 20
+ROUNDS = 5
+TICK = 0.005
+
+
+def populate(uri: str) -> None:
+    with Session(create_engine(uri)) as session:
+        now = datetime.datetime.utcnow()
+        for i in range(USERS):
+            session.add(
+                User(
+                    name=f"user{i}",
+                    auth_token="token",
+                    refresh_token="token",
+                    token_valid=now,
+                    email=f"user{i}@example.org",
+                    kindle_mail=f"user{i}@kindle.com",
+                )
+            )
+        for i in range(JOBS):
+            session.add(Job(article=i, title=f"Article {i}", format="epub", user_name=f"user{i % USERS}"))
+        session.commit()
+
+
+async def probe(lags: list[float], done: asyncio.Event) -> None:
+    while not done.is_set():
+        start = time.monotonic()
+        await asyncio.sleep(TICK)
+        lags.append(time.monotonic() - start - TICK)
+
+
+async def sync_worker(uri: str, n: int) -> None:
+    # What the consumer did before: a sync session called straight from the coroutine.
+    engine = create_engine(uri)
+    for _ in range(ROUNDS):
+        with Session(engine) as session:
+            session.scalars(select(Job).options(joinedload(Job.user)).where(Job.state == "pending")).all()
+            session.execute(update(Job).where(Job.article == n).values(attempts=Job.attempts + 1))
+            session.commit()
+        await asyncio.sleep(0)
+
+
+async def async_worker(uri: str, n: int) -> None:
+    sessionmaker = async_sessionmaker(create_async_engine(uri.replace("sqlite://", "sqlite+aiosqlite://")))
+    for _ in range(ROUNDS):
+        async with sessionmaker() as session:
+            (await session.scalars(select(Job).options(joinedload(Job.user)).where(Job.state == "pending"))).all()
+            await session.execute(update(Job).where(Job.article == n).values(attempts=Job.attempts + 1))
+            await session.commit()
+
+
+async def measure(uri: str, worker: str) -> tuple[float, list[float]]:
+    lags: list[float] = []
+    done = asyncio.Event()
+    probing = asyncio.ensure_future(probe(lags, done))
+
+    start = time.monotonic()
+    await asyncio.gather(*(globals()[worker](uri, n) for n in range(TASKS)))
+    elapsed = time.monotonic() - start
+
+    done.set()
+    await probing
+    return elapsed, lags
+
+
+def main() -> None:
+    with tempfile.TemporaryDirectory() as directory:
+        uri = f"sqlite:///{os.path.join(directory, 'bench.db')}"
+        Base.metadata.create_all(create_engine(uri))
+        populate(uri)
+
+        print(
+            f"{'session':<8} {'total (s)':>10} {'ticks':>6} {'p50 lag (ms)':>13} {'p99 lag (ms)':>13} {'max (ms)':>9}"
+        )
+        for name, worker in (("sync", "sync_worker"), ("async", "async_worker")):
+            elapsed, lags = asyncio.run(measure(uri, worker))
+            quantiles = statistics.quantiles(lags, n=100, method="inclusive") if len(lags) > 1 else lags * 99
+            print(
+                f"{name:<8} {elapsed:>10.2f} {len(lags):>6} {quantiles[49] * 1000:>13.1f} "
+                f"{quantiles[98] * 1000:>13.1f} {max(lags) * 1000:>9.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""Compare full and metadata only entry listings per 1,000 entries.
+
+Run from the repository root: python -m benchmarks.entries_listing
+"""
+
+import json
+import time
+from collections.abc import Callable
+from typing import Any
+
+import orjson
+
+from wallabag_kindle_consumer.wallabag import Article, Tag
+
+ENTRIES = 1000
+ROUNDS = 20
+CONTENT = "<p>" + "Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * 300 + "</p>"
+TAG = Tag(tag="kindle", format="epub")
+
+
+def make_listing(with_content: bool) -> bytes:
+    items = []
+    for i in range(ENTRIES):
+        entry: dict[str, Any] = {
+            "id": i,
+            "title": f"Article {i}",
+            "url": f"https://example.org/articles/{i}",
+            "domain_name": "example.org",
+            "created_at": "2024-01-01T10:00:00+0000",
+            "updated_at": "2024-01-01T10:00:00+0000",
+            "reading_time": 5,
+            "tags": [{"id": 1, "label": "kindle", "slug": "kindle"}, {"id": 2, "label": "news", "slug": "news"}],
+        }
+        if with_content:
+            entry["content"] = CONTENT
+        items.append(entry)
+
+    return json.dumps({"page": 1, "pages": 1, "_embedded": {"items": items}}).encode()
+
+
+def old_article(entry: dict[str, Any]) -> int:
+    # The former Article kept the raw tag list and scanned it on every lookup.
+    tags = entry["tags"]
+    for t in tags:
+        if t["label"] == TAG.tag:
+            return t["id"]
+    return -1
+
+
+def new_article(entry: dict[str, Any]) -> int:
+    return Article.from_entry(entry, TAG).tag_id()
+
+
+def measure(body: bytes, loads: Callable[[bytes], Any], build: Callable[[dict[str, Any]], int]) -> float:
+    start = time.process_time()
+    for _ in range(ROUNDS):
+        for entry in loads(body)["_embedded"]["items"]:
+            build(entry)
+    return (time.process_time() - start) / ROUNDS * 1000
+
+
+def main() -> None:
+    full = make_listing(with_content=True)
+    metadata = make_listing(with_content=False)
+
+    print(f"{'listing':<10} {'bytes':>12} {'json + dict (ms)':>18} {'orjson + slots (ms)':>20}")
+    for name, body in (("full", full), ("metadata", metadata)):
+        before = measure(body, json.loads, old_article)
+        after = measure(body, orjson.loads, new_article)
+        print(f"{name:<10} {len(body):>12,} {before:>18.2f} {after:>20.2f}")
+
+
+if __name__ == "__main__":
+    main()
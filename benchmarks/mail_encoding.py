@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""Compare the throughput of rendering mails in the event loop and in worker processes.
+
+Run from the repository root: python -m benchmarks.mail_encoding
+"""
+
+import asyncio
+import multiprocessing
+import os
+import statistics
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from wallabag_kindle_consumer.message import Message, render
+
+SIZE = 10 * 1024 * 1024
+MAILS = 16
+WORKERS = (1, 2, 4, 8)
+TICK = 0.005
+
+
+async def probe(lags: list[float], done: asyncio.Event) -> None:
+    while not done.is_set():
+        start = time.monotonic()
+        await asyncio.sleep(TICK)
+        lags.append(time.monotonic() - start - TICK)
+
+
+async def in_loop(path: str) -> None:
+    # What the sender does without workers: the message is encoded chunk by chunk while it is sent.
+    msg = Message("from@example.org", "to@kindle.com", "Send article 'benchmark'", "Sent by the benchmark.")
+    with open(path, "rb") as f:
+        msg.attach("benchmark.pdf", f)
+        for _ in msg:
+            await asyncio.sleep(0)
+
+
+async def in_workers(executor: ProcessPoolExecutor, path: str, directory: str) -> None:
+    loop = asyncio.get_running_loop()
+    fd, out = tempfile.mkstemp(dir=directory, suffix=".eml")
+    os.close(fd)
+    try:
+        await loop.run_in_executor(
+            executor,
+            render,
+            "from@example.org",
+            "to@kindle.com",
+            "Send article 'benchmark'",
+            "Sent by the benchmark.",
+            [("benchmark.pdf", path)],
+            out,
+        )
+    finally:
+        os.unlink(out)
+
+
+async def measure(path: str, directory: str, workers: int) -> tuple[float, list[float]]:
+    lags: list[float] = []
+    done = asyncio.Event()
+    probing = asyncio.ensure_future(probe(lags, done))
+
+    start = time.monotonic()
+    if workers:
+        with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            # Started before measuring, a spawned worker imports the package first.
+            await asyncio.gather(*(asyncio.get_running_loop().run_in_executor(executor, int) for _ in range(workers)))
+            start = time.monotonic()
+            await asyncio.gather(*(in_workers(executor, path, directory) for _ in range(MAILS)))
+    else:
+        await asyncio.gather(*(in_loop(path) for _ in range(MAILS)))
+    elapsed = time.monotonic() - start
+
+    done.set()
+    await probing
+    return elapsed, lags
+
+
+def main() -> None:
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "benchmark.pdf")
+        with open(path, "wb") as f:
+            f.write(os.urandom(SIZE))
+
+        print(f"{MAILS} mails with a {SIZE // 1024 // 1024} MB attachment on {os.cpu_count()} cores")
+        print(f"{'workers':<8} {'total (s)':>10} {'MB/s':>8} {'p99 lag (ms)':>13}")
+        for workers in (0, *WORKERS):
+            elapsed, lags = asyncio.run(measure(path, directory, workers))
+            quantiles = statistics.quantiles(lags, n=100, method="inclusive") if len(lags) > 1 else lags * 99
+            throughput = MAILS * SIZE / elapsed / 1024 / 1024
+            print(f"{workers:<8} {elapsed:>10.2f} {throughput:>8.1f} {quantiles[98] * 1000:>13.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""Compare the peak memory of rendering a mail with a 20 MB PDF attachment.
+
+Run from the repository root: python -m benchmarks.mail_memory
+"""
+
+import multiprocessing
+import os
+import resource
+import tempfile
+from email.encoders import encode_base64
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+from wallabag_kindle_consumer.message import Message
+
+SIZE = 20 * 1024 * 1024
+
+
+def peak_rss() -> int:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def as_string(path: str) -> int:
+    # What the sender did before: the whole export, the encoded part and the rendered string in memory.
+    with open(path, "rb") as f:
+        data = f.read()
+
+    msg = MIMEMultipart()
+    msg["Subject"] = "Send article 'benchmark'"
+    msg.attach(MIMEText("This email has been automatically sent."))
+    attachment = MIMEApplication(data)
+    encode_base64(attachment)
+    attachment.add_header("Content-Disposition", "attachment", filename="benchmark.pdf")
+    msg.attach(attachment)
+    return len(msg.as_string())
+
+
+def streamed(path: str) -> int:
+    msg = Message(
+        "from@example.org", "to@kindle.com", "Send article 'benchmark'", "This email has been automatically sent."
+    )
+    with open(path, "rb") as f:
+        msg.attach("benchmark.pdf", f)
+        return sum(len(chunk) for chunk in msg)
+
+
+def run(name: str, path: str, results: "multiprocessing.Queue[tuple[str, int, int]]") -> None:
+    before = peak_rss()
+    size = globals()[name](path)
+    results.put((name, size, peak_rss() - before))
+
+
+def main() -> None:
+    with tempfile.NamedTemporaryFile(suffix=".pdf") as pdf:
+        pdf.write(os.urandom(SIZE))
+        pdf.flush()
+
+        ctx = multiprocessing.get_context("spawn")
+        results: "multiprocessing.Queue[tuple[str, int, int]]" = ctx.Queue()
+        print(f"{'renderer':<10} {'message bytes':>14} {'peak RSS growth':>16}")
+        for name in ("as_string", "streamed"):
+            proc = ctx.Process(target=run, args=(name, pdf.name, results))
+            proc.start()
+            name, size, growth = results.get()
+            proc.join()
+            print(f"{name:<10} {size:>14,} {growth / 1024 / 1024:>13.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -7,12 +7,14 @@ from collections.abc import Callable
 
 import uvloop
 
-from wallabag_kindle_consumer import models
+from wallabag_kindle_consumer import migrations, models
 from wallabag_kindle_consumer.config import Configuration
 from wallabag_kindle_consumer.consumer import Consumer
 from wallabag_kindle_consumer.interface import App
 from wallabag_kindle_consumer.logger import logger
+from wallabag_kindle_consumer.metrics import REGISTRY, MetricsServer, monitor_loop_lag
 from wallabag_kindle_consumer.refresher import Refresher
+from wallabag_kindle_consumer.scheduler import ByteBudget
 from wallabag_kindle_consumer.sender import Sender
 from wallabag_kindle_consumer.wallabag import Wallabag
 
@@ -24,6 +26,7 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument("--interface", help="Start web interface", action="store_true")
     parser.add_argument("--consumer", help="Start article consumer", action="store_true")
     parser.add_argument("--create_db", help="Try to create the db", action="store_true")
+    parser.add_argument("--migrate_db", help="Upgrade the db schema to the current version", action="store_true")
 
     return parser.parse_args()
 
@@ -39,21 +42,50 @@ if __name__ == "__main__":
     logger.setLevel(config.log_level)
 
     if args.create_db:
-        models.create_db(config)
-        logger.info("Database created.")
+        if loop.run_until_complete(models.create_db(config)):
+            logger.info("Database created.")
+        else:
+            logger.warning("Database exists already, run with --migrate_db to upgrade it.")
+
+    if args.migrate_db:
+        old_version, new_version = loop.run_until_complete(migrations.migrate_db(config))
+        if old_version is None:
+            logger.info(f"Database created with schema version {new_version}.")
+        elif old_version == new_version:
+            logger.info(f"Database schema is up to date at version {new_version}.")
+        else:
+            logger.info(f"Database schema migrated from version {old_version} to {new_version}.")
 
     on_stop: list[Callable[[], None]] = []
+    # Tasks which finish the work in hand once stopped, the loop runs until they are done.
+    stopping: list[asyncio.Future[None]] = []
+
+    if config.metrics:
+        REGISTRY.enabled = True
+        loop.create_task(monitor_loop_lag())
+        if not args.interface:
+            logger.info("Create Metrics Server")
+            metrics_server = MetricsServer(config)
+            loop.create_task(metrics_server.register_server())
+            on_stop.append(lambda: metrics_server.stop())
+
+    async def _shutdown() -> None:
+        await asyncio.gather(*stopping, return_exceptions=True)
+        loop.stop()
 
     def _stop() -> None:
         for cb in on_stop:
             cb()
 
-        loop.stop()
+        loop.create_task(_shutdown())
 
     loop.add_signal_handler(signal.SIGTERM, _stop)
     loop.add_signal_handler(signal.SIGINT, _stop)
 
-    wallabag = Wallabag(config)
+    # Shared by the exports and the mails, so a burst of large articles can't exhaust the memory.
+    budget = ByteBudget("bytes", config.inflight_budget * 1024 * 1024) if config.inflight_budget else None
+    wallabag = Wallabag(config, budget)
+    loop.run_until_complete(wallabag.open())
     sender = Sender(
         loop=loop,
         from_addr=config.smtp_from,
@@ -62,6 +94,11 @@ if __name__ == "__main__":
         smtp_user=config.smtp_user,
         smtp_passwd=config.smtp_passwd,
         smtp_tls=config.smtp_tls,
+        pool_size=config.smtp_pool_size,
+        idle_timeout=config.smtp_idle_timeout,
+        timeout=config.smtp_timeout,
+        encode_workers=config.encode_workers,
+        budget=budget,
     )
 
     if args.refresher:
@@ -73,13 +110,23 @@ if __name__ == "__main__":
     if args.consumer:
         logger.info("Create Consumer")
         consumer = Consumer(wallabag, config, sender)
-        loop.create_task(consumer.consume())
+        stopping.append(loop.create_task(consumer.consume()))
         on_stop.append(lambda: consumer.stop())
 
     if args.interface:
         logger.info("Create Interface")
-        webapp = App(config, wallabag)
+        user_listeners: list[Callable[[str], None]] = []
+        if args.refresher:
+            user_listeners.append(refresher.notify)
+        if args.consumer:
+            user_listeners.append(consumer.notify)
+        webapp = App(config, wallabag, user_listeners=user_listeners)
         loop.create_task(webapp.register_server())
         on_stop.append(lambda: webapp.stop())
 
-    loop.run_forever()
+    try:
+        loop.run_forever()
+    finally:
+        loop.run_until_complete(wallabag.close())
+        loop.run_until_complete(sender.close())
+        loop.run_until_complete(models.dispose_engines())
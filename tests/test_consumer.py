@@ -0,0 +1,119 @@
+import asyncio
+import datetime
+import io
+from collections.abc import Iterator
+from pathlib import Path
+from typing import IO
+
+import pytest
+from sqlalchemy import select
+from sqlalchemy.orm import contains_eager
+
+from wallabag_kindle_consumer import models
+from wallabag_kindle_consumer.config import Configuration
+from wallabag_kindle_consumer.consumer import Consumer
+from wallabag_kindle_consumer.models import Job, User
+from wallabag_kindle_consumer.sender import Sender
+from wallabag_kindle_consumer.wallabag import Wallabag
+
+
+@pytest.fixture
+def config(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Iterator[Configuration]:
+    env = {
+        "WALLABAG_HOST": "http://127.0.0.1:1",
+        "DB_URI": f"sqlite:///{tmp_path / 'db.sqlite'}",
+        "CLIENT_ID": "id",
+        "CLIENT_SECRET": "secret",
+        "DOMAIN": "http://127.0.0.1",
+        "SMTP_FROM": "from@example.org",
+        "SMTP_HOST": "127.0.0.1",
+        "SMTP_PORT": "1",
+        "SMTP_USER": "",
+        "SMTP_PASSWD": "",
+        "EXPORT_DIR": str(tmp_path / "exports"),
+        "LEASE_TTL": "60",
+    }
+    for key, value in env.items():
+        monkeypatch.setenv(key, value)
+    yield Configuration.build()
+    asyncio.run(models.dispose_engines())
+
+
+class RecordingSender(Sender):
+    def __init__(self, config: Configuration):
+        super().__init__(asyncio.get_running_loop(), config.smtp_from, config.smtp_host, config.smtp_port)
+        self.sent: list[int] = []
+
+    async def send_mails(self, jobs: list[tuple[Job, IO[bytes]]]) -> bool:
+        self.sent.extend(job.id for job, _ in jobs)
+        return True
+
+
+async def _setup(config: Configuration, jobs: list[Job]) -> None:
+    await models.create_db(config)
+    async with models.session_maker(config)() as session:
+        session.add(
+            User(
+                name="user",
+                auth_token="token",
+                refresh_token="refresh",
+                token_valid=datetime.datetime.utcnow() + datetime.timedelta(hours=1),
+                email="user@example.org",
+                kindle_mail="user@kindle.com",
+            )
+        )
+        session.add_all(jobs)
+        await session.commit()
+
+
+def _job(article: int, state: str, age: float = 0) -> Job:
+    changed_at = datetime.datetime.utcnow() - datetime.timedelta(seconds=age)
+    return Job(article=article, title="Article", format="pdf", user_name="user", state=state, changed_at=changed_at)
+
+
+def test_schedule_leaves_jobs_to_their_previous_owner(config: Configuration) -> None:
+    async def run() -> set[int]:
+        await _setup(
+            config,
+            [
+                _job(1, "sending"),
+                _job(2, "exporting"),
+                _job(3, "sending", age=120),
+                _job(4, "exported"),
+            ],
+        )
+        consumer = Consumer(Wallabag(config), config, RecordingSender(config))
+        await consumer.leases.renew()
+        await consumer.schedule()
+
+        queued: set[int] = set()
+        while consumer.export_queue.qsize():
+            queued.update(await consumer.export_queue.get())
+        async with consumer.sessionmaker() as session:
+            articles = await session.scalars(select(Job.article).where(Job.id.in_(queued)))
+            return set(articles)
+
+    # The previous owner may still send the jobs it is busy with, those left alone for a lease are resumed.
+    assert asyncio.run(run()) == {3, 4}
+
+
+def test_send_jobs_skips_partitions_handed_over(config: Configuration) -> None:
+    async def run() -> tuple[list[int], bool, str]:
+        await _setup(config, [_job(1, "exported")])
+        sender = RecordingSender(config)
+        consumer = Consumer(Wallabag(config), config, sender)
+        async with consumer.sessionmaker() as session:
+            job = (await session.scalars(select(Job).join(Job.user).options(contains_eager(Job.user)))).one()
+
+        # Not renewed, so the consumer holds no partitions.
+        data: IO[bytes] = io.BytesIO(b"%PDF")
+        await consumer.send_jobs([(job, data)])
+
+        async with consumer.sessionmaker() as session:
+            state = (await session.scalars(select(Job.state))).one()
+        return sender.sent, data.closed, state
+
+    sent, closed, state = asyncio.run(run())
+    assert sent == []
+    assert closed
+    assert state == "exported"
@@ -0,0 +1,58 @@
+import asyncio
+import email
+import io
+from collections.abc import Iterator
+from email import policy
+
+import pytest
+
+from wallabag_kindle_consumer.message import Message
+from wallabag_kindle_consumer.smtp import SMTPPool
+
+
+def test_non_ascii_subject_is_encoded() -> None:
+    msg = Message("from@example.org", "to@kindle.com", "Send article 'Café fonctionnalités'", "Sent.")
+    msg.attach("Café.pdf", io.BytesIO(b"%PDF"))
+
+    data = b"".join(msg)
+    data.decode("ascii")
+
+    parsed = email.message_from_bytes(data, policy=policy.default)
+    assert parsed["Subject"] == "Send article 'Café fonctionnalités'"
+    attachment = next(parsed.iter_attachments())
+    assert attachment.get_filename() == "Café.pdf"
+    assert attachment.get_content() == b"%PDF"
+
+
+def test_failure_during_data_drops_connection() -> None:
+    async def run() -> list[bytes]:
+        received: list[bytes] = []
+
+        async def serve(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+            writer.write(b"220 test\r\n")
+            while line := await reader.readline():
+                received.append(line)
+                command = line[:4].upper()
+                if command == b"DATA":
+                    writer.write(b"354 go ahead\r\n")
+                elif command == b"QUIT":
+                    writer.write(b"221 bye\r\n")
+                elif command in (b"EHLO", b"MAIL", b"RCPT"):
+                    writer.write(b"250 ok\r\n")
+            writer.close()
+
+        def failing() -> Iterator[bytes]:
+            yield b"Subject: test\r\n\r\n"
+            raise ValueError("cannot render")
+
+        server = await asyncio.start_server(serve, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        pool = SMTPPool("127.0.0.1", port, starttls=False, timeout=5)
+        async with server:
+            with pytest.raises(ValueError):
+                await asyncio.wait_for(pool.sendmail("from@example.org", ["to@kindle.com"], failing()), 2)
+            await pool.close()
+        return received
+
+    received = asyncio.run(run())
+    assert not any(line.upper().startswith(b"QUIT") for line in received)
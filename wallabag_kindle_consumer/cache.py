@@ -0,0 +1,111 @@
+import asyncio
+import hashlib
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+from typing import IO
+
+from wallabag_kindle_consumer.logger import logger
+
+
+class ExportCache:
+    def __init__(self, directory: str, max_size: int):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._entries: OrderedDict[str, int] = OrderedDict()
+        self._size = 0
+        self._load()
+
+    def _load(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+
+        files = []
+        for entry in os.scandir(self.directory):
+            if not entry.is_file():
+                continue
+            if entry.name.endswith(".tmp"):
+                # Left over from an interrupted write.
+                os.unlink(entry.path)
+                continue
+            stat = entry.stat()
+            files.append((stat.st_mtime, entry.name, stat.st_size))
+
+        for _, name, size in sorted(files):
+            self._entries[name] = size
+            self._size += size
+
+        self._evict()
+        logger.info(f"Export cache in {self.directory} holds {len(self._entries)} files ({self._size} bytes)")
+
+    @staticmethod
+    def key(host: str, article_id: int, format: str, updated_at: str) -> str:
+        return hashlib.sha256(f"{host}\0{article_id}\0{format}\0{updated_at}".encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def _open(self, key: str) -> IO[bytes] | None:
+        try:
+            # The modification time orders the files for eviction after a restart.
+            os.utime(self._path(key))
+            return open(self._path(key), "rb")
+        except FileNotFoundError:
+            return None
+
+    def _write(self, key: str, data: IO[bytes]) -> int:
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                shutil.copyfileobj(data, f)
+                size = f.tell()
+            os.replace(tmp, self._path(key))
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        finally:
+            data.seek(0)
+        return size
+
+    def _evict(self) -> None:
+        while self._size > self.max_size and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self._size -= size
+            self.evictions += 1
+            try:
+                os.unlink(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    async def get(self, key: str) -> IO[bytes] | None:
+        if key not in self._entries:
+            self.misses += 1
+            return None
+
+        data = await asyncio.get_running_loop().run_in_executor(None, self._open, key)
+        if data is None:
+            self._size -= self._entries.pop(key, 0)
+            self.misses += 1
+            return None
+
+        if key in self._entries:
+            self._entries.move_to_end(key)
+        self.hits += 1
+        return data
+
+    async def put(self, key: str, data: IO[bytes]) -> None:
+        data.seek(0, os.SEEK_END)
+        too_large = data.tell() > self.max_size
+        data.seek(0)
+        if too_large:
+            return
+
+        size = await asyncio.get_running_loop().run_in_executor(None, self._write, key, data)
+
+        self._size += size - self._entries.pop(key, 0)
+        self._entries[key] = size
+        self._evict()
@@ -21,13 +21,63 @@ class Configuration:
     smtp_user: str
     smtp_passwd: str
     smtp_tls: bool
+    smtp_pool_size: int
+    smtp_idle_timeout: float
+    smtp_timeout: float
+    encode_workers: int
     tag: str
     default_format: str
     refresh_grace: int
+    refresh_jitter: int
     consume_interval: int
+    poll_max_interval: int
+    poll_backoff: float
     interface_host: str
     interface_port: int
     log_level: str
+    metrics: bool
+    metrics_port: int
+    http_pool_size: int
+    http_pool_per_host: int
+    http_keepalive: float
+    http_dns_ttl: int
+    http_timeout: float
+    http_connect_timeout: float
+    fetch_per_page: int
+    fetch_lookahead: int
+    tag_batch_size: int
+    full_sync_interval: int
+    sync_overlap: int
+    export_cache_dir: str
+    export_cache_size: int
+    export_spool_size: int
+    inflight_budget: int
+    batch_mails: bool
+    batch_max_size: int
+    batch_max_articles: int
+    concurrency: int
+    concurrency_per_user: int
+    concurrency_per_host: int
+    concurrency_smtp: int
+    fetch_workers: int
+    export_workers: int
+    send_workers: int
+    queue_size: int
+    fast_lane_articles: int
+    fast_lane_weight: int
+    lease_partitions: int
+    lease_ttl: int
+    export_dir: str
+    max_attempts: int
+    retry_delay: int
+    retry_max_delay: int
+    job_retention: int
+    db_pool_size: int
+    db_max_overflow: int
+    db_pool_timeout: float
+    sqlite_wal: bool
+    sqlite_busy_timeout: int
+    sqlite_mmap_size: int
 
     @classmethod
     def build(cls, config_file_path: str | None = None) -> Configuration:
@@ -49,13 +99,63 @@ class Configuration:
                 smtp_user=cfg("SMTP_USER"),
                 smtp_passwd=cfg("SMTP_PASSWD"),
                 smtp_tls=cfg("SMTP_TLS", default=True, cast=bool),
+                smtp_pool_size=cfg("SMTP_POOL_SIZE", default=4, cast=int),
+                smtp_idle_timeout=cfg("SMTP_IDLE_TIMEOUT", default=60, cast=float),
+                smtp_timeout=cfg("SMTP_TIMEOUT", default=60, cast=float),
+                encode_workers=cfg("ENCODE_WORKERS", default=0, cast=int),
                 tag=cfg("TAG", default="kindle"),
                 default_format=cfg("DEFAULT_FORMAT", default="epub"),
                 refresh_grace=cfg("REFRESH_GRACE", default=120, cast=int),
+                refresh_jitter=cfg("REFRESH_JITTER", default=60, cast=int),
                 consume_interval=cfg("CONSUME_INTERVAL", default=30, cast=int),
+                poll_max_interval=cfg("POLL_MAX_INTERVAL", default=600, cast=int),
+                poll_backoff=cfg("POLL_BACKOFF", default=2.0, cast=float),
                 interface_host=cfg("INTERFACE_HOST", default="127.0.0.1"),
                 interface_port=cfg("INTERFACE_PORT", default=8080, cast=int),
                 log_level=cfg("LOG_LEVEL", default="INFO"),
+                metrics=cfg("METRICS", default=False, cast=bool),
+                metrics_port=cfg("METRICS_PORT", default=9100, cast=int),
+                http_pool_size=cfg("HTTP_POOL_SIZE", default=100, cast=int),
+                http_pool_per_host=cfg("HTTP_POOL_PER_HOST", default=20, cast=int),
+                http_keepalive=cfg("HTTP_KEEPALIVE", default=30, cast=float),
+                http_dns_ttl=cfg("HTTP_DNS_TTL", default=300, cast=int),
+                http_timeout=cfg("HTTP_TIMEOUT", default=120, cast=float),
+                http_connect_timeout=cfg("HTTP_CONNECT_TIMEOUT", default=10, cast=float),
+                fetch_per_page=cfg("FETCH_PER_PAGE", default=100, cast=int),
+                fetch_lookahead=cfg("FETCH_LOOKAHEAD", default=2, cast=int),
+                tag_batch_size=cfg("TAG_BATCH_SIZE", default=25, cast=int),
+                full_sync_interval=cfg("FULL_SYNC_INTERVAL", default=3600, cast=int),
+                sync_overlap=cfg("SYNC_OVERLAP", default=300, cast=int),
+                export_cache_dir=cfg("EXPORT_CACHE_DIR", default=""),
+                export_cache_size=cfg("EXPORT_CACHE_SIZE", default=512, cast=int),
+                export_spool_size=cfg("EXPORT_SPOOL_SIZE", default=1, cast=int),
+                inflight_budget=cfg("INFLIGHT_BUDGET", default=128, cast=int),
+                batch_mails=cfg("BATCH_MAILS", default=False, cast=bool),
+                batch_max_size=cfg("BATCH_MAX_SIZE", default=25, cast=int),
+                batch_max_articles=cfg("BATCH_MAX_ARTICLES", default=10, cast=int),
+                concurrency=cfg("CONCURRENCY", default=32, cast=int),
+                concurrency_per_user=cfg("CONCURRENCY_PER_USER", default=4, cast=int),
+                concurrency_per_host=cfg("CONCURRENCY_PER_HOST", default=16, cast=int),
+                concurrency_smtp=cfg("CONCURRENCY_SMTP", default=4, cast=int),
+                fetch_workers=cfg("FETCH_WORKERS", default=4, cast=int),
+                export_workers=cfg("EXPORT_WORKERS", default=8, cast=int),
+                send_workers=cfg("SEND_WORKERS", default=4, cast=int),
+                queue_size=cfg("QUEUE_SIZE", default=32, cast=int),
+                fast_lane_articles=cfg("FAST_LANE_ARTICLES", default=5, cast=int),
+                fast_lane_weight=cfg("FAST_LANE_WEIGHT", default=4, cast=int),
+                lease_partitions=cfg("LEASE_PARTITIONS", default=64, cast=int),
+                lease_ttl=cfg("LEASE_TTL", default=60, cast=int),
+                export_dir=cfg("EXPORT_DIR", default="exports"),
+                max_attempts=cfg("MAX_ATTEMPTS", default=5, cast=int),
+                retry_delay=cfg("RETRY_DELAY", default=60, cast=int),
+                retry_max_delay=cfg("RETRY_MAX_DELAY", default=3600, cast=int),
+                job_retention=cfg("JOB_RETENTION", default=7, cast=int),
+                db_pool_size=cfg("DB_POOL_SIZE", default=5, cast=int),
+                db_max_overflow=cfg("DB_MAX_OVERFLOW", default=10, cast=int),
+                db_pool_timeout=cfg("DB_POOL_TIMEOUT", default=30, cast=float),
+                sqlite_wal=cfg("SQLITE_WAL", default=True, cast=bool),
+                sqlite_busy_timeout=cfg("SQLITE_BUSY_TIMEOUT", default=5000, cast=int),
+                sqlite_mmap_size=cfg("SQLITE_MMAP_SIZE", default=256, cast=int),
             )
         except UndefinedValueError:
             logging.exception("Failed to build configuration object")
@@ -1,44 +1,512 @@
 #!/usr/bin/env python3
 import asyncio
+import contextlib
 import datetime
+import os
+import random
+import shutil
+import statistics
+import tempfile
+from collections import defaultdict, deque
+from collections.abc import Awaitable, Callable
+from typing import IO, Any
 
-from sqlalchemy.orm import Session, joinedload
+from sqlalchemy import delete, or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import contains_eager
 
+from wallabag_kindle_consumer import metrics
 from wallabag_kindle_consumer.config import Configuration
+from wallabag_kindle_consumer.leases import Leases
 from wallabag_kindle_consumer.logger import logger
-from wallabag_kindle_consumer.models import Job, User, context_session
+from wallabag_kindle_consumer.models import Job, User, insert_ignore, pool_stats, session_maker
+from wallabag_kindle_consumer.scheduler import FairQueue, Scheduler
 from wallabag_kindle_consumer.sender import Sender
-from wallabag_kindle_consumer.wallabag import Wallabag
+from wallabag_kindle_consumer.wallabag import Article, Wallabag
+
+ACTIVE_STATES = ("pending", "exporting", "exported", "sending")
+STORED_STATES = ("exported", "sending")
+# Jobs a consumer is working on, possibly the previous owner of a partition which was just handed over.
+BUSY_STATES = ("exporting", "sending")
+# The number of recently sent jobs the latency quantiles are computed from.
+LATENCY_SAMPLES = 1000
 
 
 class Consumer:
     def __init__(self, wallabag: Wallabag, cfg: Configuration, sender: Sender):
         self.wallabag = wallabag
-        self.sessionmaker = context_session(cfg)
+        self.sessionmaker = session_maker(cfg)
+        self.pool_stats = pool_stats(cfg)
         self.interval = cfg.consume_interval
+        self.poll_interval = cfg.consume_interval
+        self.poll_max_interval = float(max(cfg.poll_max_interval, cfg.consume_interval))
+        self.poll_backoff = cfg.poll_backoff
+        self.full_sync_interval = datetime.timedelta(seconds=cfg.full_sync_interval)
+        self.sync_overlap = datetime.timedelta(seconds=cfg.sync_overlap)
         self.sender = sender
+        self.batch_mails = cfg.batch_mails
+        self.batch_max_size = cfg.batch_max_size * 1024 * 1024
+        self.batch_max_articles = cfg.batch_max_articles
+        self.host = cfg.wallabag_host
+        self.scheduler = Scheduler(
+            total=cfg.concurrency,
+            per_user=cfg.concurrency_per_user,
+            per_host=cfg.concurrency_per_host,
+            smtp=cfg.concurrency_smtp,
+        )
+        self.fetch_workers = cfg.fetch_workers
+        self.export_workers = cfg.export_workers
+        self.send_workers = cfg.send_workers
+        self.fetch_queue: asyncio.Queue[str] = asyncio.Queue(cfg.queue_size)
+        # Only job ids wait for an export, so the queue is unbounded to order all of them fairly.
+        self.export_queue: FairQueue[list[int]] = FairQueue(cfg.fast_lane_weight)
+        self.fast_lane_articles = cfg.fast_lane_articles
+        self.send_queue: asyncio.Queue[list[tuple[Job, IO[bytes]]]] = asyncio.Queue(cfg.queue_size)
+        self.export_dir = cfg.export_dir
+        self.max_attempts = cfg.max_attempts
+        self.retry_delay = cfg.retry_delay
+        self.retry_max_delay = cfg.retry_max_delay
+        self.job_retention = datetime.timedelta(days=cfg.job_retention)
+        self.leases = Leases(cfg)
         self.running = True
 
+        os.makedirs(self.export_dir, exist_ok=True)
+
         self._wait_fut: asyncio.Future[None] | None = None
+        self._last_full_sync: dict[str, datetime.datetime] = {}
+        self._tag_requests_saved = 0
+        self._fetching: set[str] = set()
+        self._next_poll: dict[str, datetime.datetime] = {}
+        self._poll_intervals: dict[str, float] = {}
+        self._in_flight: set[int] = set()
+        # The stages stopping, and the workers handling an item.
+        self._stopped: set[str] = set()
+        self._busy: set["asyncio.Task[Any] | None"] = set()
+        self._latencies: deque[float] = deque(maxlen=LATENCY_SAMPLES)
+
+        self._register_metrics()
+
+    def _register_metrics(self) -> None:
+        queues: dict[str, "asyncio.Queue[Any] | FairQueue[Any]"] = {
+            "fetch": self.fetch_queue,
+            "export": self.export_queue,
+            "send": self.send_queue,
+        }
+        metrics.REGISTRY.gauge(
+            "wallabag_kindle_queue_size",
+            "Items waiting for a stage of the consumer.",
+            lambda: [({"stage": stage}, queue.qsize()) for stage, queue in queues.items()],
+        )
+        metrics.REGISTRY.gauge(
+            "wallabag_kindle_user_jobs_waiting",
+            "Jobs of a user waiting for an export.",
+            lambda: [({"user": name}, depth) for name, depth in self.queue_depths().items()],
+        )
+        metrics.REGISTRY.gauge(
+            "wallabag_kindle_user_poll_interval_seconds",
+            "Interval between the polls of a user, longer while the user tags nothing.",
+            lambda: [({"user": name}, interval) for name, interval in self.cadence().items()],
+        )
+        metrics.REGISTRY.gauge(
+            "wallabag_kindle_tag_to_send_seconds",
+            f"Quantiles of the time from finding tagged articles to sending them over the last {LATENCY_SAMPLES} jobs.",
+            lambda: zip(({"quantile": "0.5"}, {"quantile": "0.99"}), self.latency() or ()),
+        )
+        metrics.REGISTRY.gauge(
+            "wallabag_kindle_partitions_owned",
+            "Partitions of the users leased by this consumer.",
+            lambda: [({}, len(self.leases.owned))],
+        )
+        budget = self.wallabag.budget
+        if budget is not None:
+            metrics.REGISTRY.gauge(
+                "wallabag_kindle_inflight_bytes",
+                "Bytes of exports and mails in flight.",
+                lambda: [({}, budget.in_use)],
+            )
+
+    def _since(self, user: User) -> datetime.datetime | None:
+        last_full_sync = self._last_full_sync.get(user.name)
+        if not self.full_sync_interval or user.last_check is None or last_full_sync is None:
+            return None
+
+        if datetime.datetime.utcnow() - last_full_sync >= self.full_sync_interval:
+            return None
+
+        return user.last_check - self.sync_overlap
+
+    async def fetch_jobs(self, name: str) -> int:
+        async with self.sessionmaker() as session:
+            user = await session.get(User, name)
+            if user is None or not user.active:
+                return 0
+            # Hand the connection back to the pool while the entries are listed.
+            await session.commit()
+
+            async with self.scheduler.slot(user.name, self.host):
+                since = self._since(user)
+                started = datetime.datetime.utcnow()
+                logger.debug(f"Fetch entries for user {user.name}" + (f" updated since {since}" if since else ""))
+
+                entries = []
+                async for entry in self.wallabag.fetch_entries(user, since):
+                    logger.info(f"Schedule job to send entry {entry.id}")
+                    entries.append(entry)
+
+                if since is None and user.last_check is not None and user.last_check >= started:
+                    self._last_full_sync[user.name] = started
+
+            ids = await self._insert_jobs(session, user, entries)
+            metrics.JOBS.inc("created", amount=len(ids))
+            # Marked before the commit makes them visible, so the schedule never queues these jobs twice.
+            self._in_flight.update(ids)
+            try:
+                await session.commit()
+            except BaseException:
+                self._in_flight.difference_update(ids)
+                raise
+
+            # Removing tags while paging would shift the entries of later pages.
+            await self.wallabag.remove_tags(user, entries, lambda: self.scheduler.slot(user.name, self.host))
+
+        await self._queue_exports(user.name, ids)
+        return len(entries)
+
+    async def _insert_jobs(self, session: AsyncSession, user: User, entries: list[Article]) -> list[int]:
+        if not entries:
+            return []
+
+        rows = [
+            {
+                "article": entry.id,
+                "title": entry.title,
+                "updated_at": entry.updated_at,
+                "format": entry.tag.format,
+                "user_name": user.name,
+            }
+            for entry in entries
+        ]
+        # An article already queued for the user is skipped, the schedule takes care of its job.
+        dialect = session.get_bind().dialect
+        stmt = insert_ignore(dialect.name, Job)
+        if not dialect.insert_executemany_returning:
+            await session.execute(stmt, rows)
+            return []
+        return list(await session.scalars(stmt.returning(Job.id), rows))
+
+    async def _queue_exports(self, user: str, ids: list[int]) -> None:
+        # A user with a few articles passes the users backfilling many of them in the fast lane.
+        fast = len(ids) <= self.fast_lane_articles
+        for group in self._groups(ids):
+            await self.export_queue.put(user, group, len(group), fast)
+
+    def _groups(self, ids: list[int]) -> list[list[int]]:
+        if not self.batch_mails:
+            return [[id] for id in ids]
+        return [ids[i : i + self.batch_max_articles] for i in range(0, len(ids), self.batch_max_articles)]
+
+    async def _export(self, job: Job) -> tuple[Job, str | None]:
+        loop = asyncio.get_running_loop()
+        async with self.scheduler.slot(job.user.name, self.host):
+            logger.info(f"Process export for job {job.article} ({job.format})")
+            try:
+                # Stored before the export is released, it counts against the byte budget until then.
+                async with self.wallabag.export_article(job.user, job.article, job.format, job.updated_at) as data:
+                    if data is None:
+                        return job, None
+                    try:
+                        return job, await loop.run_in_executor(None, self._store, job, data)
+                    except OSError:
+                        logger.exception(f"Failed to store the export of article {job.article}")
+                        return job, None
+            except Exception:
+                # Failed like a rejected export, so the job is retried with backoff and given up eventually.
+                logger.exception(f"Failed to export article {job.article} ({job.format})")
+                return job, None
+
+    def _batches(self, exports: list[tuple[Job, IO[bytes]]]) -> list[list[tuple[Job, IO[bytes]]]]:
+        if not self.batch_mails:
+            return [[export] for export in exports]
+
+        batches: list[list[tuple[Job, IO[bytes]]]] = []
+        batch: list[tuple[Job, IO[bytes]]] = []
+        batch_size = 0
+        for job, data in exports:
+            size = data.seek(0, os.SEEK_END)
+            data.seek(0)
+            if batch and (len(batch) >= self.batch_max_articles or batch_size + size > self.batch_max_size):
+                batches.append(batch)
+                batch, batch_size = [], 0
+            batch.append((job, data))
+            batch_size += size
+
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def _store(self, job: Job, data: IO[bytes]) -> str:
+        path = os.path.join(self.export_dir, f"{job.id}.{job.format}")
+        fd, tmp = tempfile.mkstemp(dir=self.export_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                data.seek(0)
+                shutil.copyfileobj(data, f)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        return path
+
+    def _discard(self, job: Job) -> None:
+        if job.export_path:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(job.export_path)
+
+    async def _update(self, jobs: list[Job], **values: Any) -> None:
+        if not jobs:
+            return
+
+        changes: dict[Any, Any] = {**values, "changed_at": datetime.datetime.utcnow()}
+        async with self.sessionmaker() as session:
+            await session.execute(update(Job).where(Job.id.in_([job.id for job in jobs])).values(changes))
+            await session.commit()
+        for job in jobs:
+            for key, value in changes.items():
+                setattr(job, key, value)
+
+    async def _retry(self, jobs: list[Job], state: str) -> None:
+        for job in jobs:
+            attempts = job.attempts + 1
+            if attempts >= self.max_attempts:
+                logger.error(f"Giving up on article {job.article} ({job.format}) after {attempts} attempts")
+                metrics.JOBS.inc("failed")
+                self._discard(job)
+                await self._update([job], state="failed", attempts=attempts, next_attempt_at=None, export_path=None)
+                continue
+
+            delay = min(self.retry_max_delay, self.retry_delay * 2 ** (attempts - 1))
+            # Jitter spreads out the retries of jobs which failed together, e.g. during an outage.
+            next_attempt_at = datetime.datetime.utcnow() + datetime.timedelta(seconds=random.uniform(delay / 2, delay))
+            logger.warning(f"Retry article {job.article} ({job.format}) at {next_attempt_at}")
+            await self._update([job], state=state, attempts=attempts, next_attempt_at=next_attempt_at)
+
+    def _busy_elsewhere(self, job: Job) -> bool:
+        return job.state in BUSY_STATES and job.changed_at > datetime.datetime.utcnow() - self.leases.ttl
+
+    async def export_jobs(self, ids: list[int]) -> None:
+        handed_over: list[int] = []
+        try:
+            async with self.sessionmaker() as session:
+                result = await session.scalars(
+                    select(Job).join(Job.user).options(contains_eager(Job.user)).where(Job.id.in_(ids))
+                )
+                # The user's partition may have been taken over by another consumer meanwhile, or handed over by one
+                # still working on the job.
+                jobs = [job for job in result if self.leases.owns(job.user.name) and not self._busy_elsewhere(job)]
+
+            # Jobs exported before a restart are sent from the stored export.
+            stored = [
+                job
+                for job in jobs
+                if job.state in STORED_STATES and job.export_path and os.path.exists(job.export_path)
+            ]
+            pending = [job for job in jobs if job.state in ACTIVE_STATES and job not in stored]
+            await self._update(pending, state="exporting")
+
+            failed = []
+            for job, path in await asyncio.gather(*(self._export(job) for job in pending)):
+                if path is None:
+                    failed.append(job)
+                    continue
+                await self._update([job], state="exported", attempts=0, next_attempt_at=None, export_path=path)
+                stored.append(job)
+            await self._retry(failed, "pending")
 
-    async def fetch_jobs(self, user: User) -> None:
-        logger.debug(f"Fetch entries for user {user.name}")
-        async for entry in self.wallabag.fetch_entries(user):
-            logger.info(f"Schedule job to send entry {entry.id}")
-            job = Job(article=entry.id, title=entry.title, format=entry.tag.format)
-            user.jobs.append(job)
-            await self.wallabag.remove_tag(user, entry)
-
-    async def process_job(self, job: Job, session: Session) -> None:
-        logger.info(f"Process export for job {job.article} ({job.format})")
-        data = await self.wallabag.export_article(job.user, job.article, job.format)
-        if data:
-            await self.sender.send_mail(job, data)
-        session.delete(job)
+            exports: list[tuple[Job, IO[bytes]]] = [
+                (job, open(job.export_path, "rb")) for job in stored if job.export_path
+            ]
+            for batch in self._batches(exports):
+                # Once stopping, the stored exports are sent by the next run.
+                if not self.running:
+                    for _, data in batch:
+                        data.close()
+                    continue
+                await self.send_queue.put(batch)
+                handed_over.extend(job.id for job, _ in batch)
+        finally:
+            self._in_flight.difference_update(set(ids) - set(handed_over))
+
+    async def send_jobs(self, batch: list[tuple[Job, IO[bytes]]]) -> None:
+        jobs = [job for job, _ in batch]
+        try:
+            # The partition may have been handed over since the export, the new owner sends the stored export.
+            if not all(self.leases.owns(job.user.name) for job in jobs):
+                for _, data in batch:
+                    data.close()
+                return
+
+            await self._update(jobs, state="sending")
+            try:
+                async with self.scheduler.smtp.hold():
+                    sent = await self.sender.send_mails(batch)
+            finally:
+                for _, data in batch:
+                    data.close()
+
+            if not sent:
+                await self._retry(jobs, "exported")
+                return
+
+            for job in jobs:
+                self._discard(job)
+            await self._update(jobs, state="sent", attempts=0, next_attempt_at=None, export_path=None)
+            metrics.JOBS.inc("sent", amount=len(jobs))
+            # The job is created when the tagged article is found, at most a poll interval after it was tagged.
+            self._latencies.extend((job.changed_at - job.created_at).total_seconds() for job in jobs)
+        finally:
+            self._in_flight.difference_update(job.id for job in jobs)
+
+    async def _worker(
+        self, name: str, queue: "asyncio.Queue[Any] | FairQueue[Any]", handle: Callable[[Any], Awaitable[None]]
+    ) -> None:
+        worker = asyncio.current_task()
+        while name not in self._stopped:
+            item = await queue.get()
+            self._busy.add(worker)
+            try:
+                await handle(item)
+            except Exception:
+                logger.exception(f"{name} worker failed")
+            finally:
+                queue.task_done()
+                self._busy.discard(worker)
+
+    def _workers(
+        self,
+        name: str,
+        queue: "asyncio.Queue[Any] | FairQueue[Any]",
+        handle: Callable[[Any], Awaitable[None]],
+        count: int,
+    ) -> list["asyncio.Future[None]"]:
+        return [asyncio.ensure_future(self._worker(name, queue, handle)) for _ in range(count)]
+
+    async def _stop_workers(self, names: set[str], workers: list["asyncio.Future[None]"]) -> None:
+        # Busy workers finish their item and stop, idle ones are cancelled right away.
+        self._stopped.update(names)
+        for worker in workers:
+            if worker not in self._busy:
+                worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+    def _drop_sends(self) -> None:
+        while not self.send_queue.empty():
+            for _, data in self.send_queue.get_nowait():
+                data.close()
+            self.send_queue.task_done()
+
+    async def _fetch_user(self, name: str) -> None:
+        found = 0
+        try:
+            found = await self.fetch_jobs(name)
+        finally:
+            self._fetching.discard(name)
+            self._polled(name, found > 0)
+
+    def _polled(self, name: str, found: bool) -> None:
+        # Users tagging articles are polled at the fastest cadence, idle ones less and less often.
+        interval: float = self.poll_interval
+        if not found:
+            interval = min(self.poll_max_interval, self._poll_intervals.get(name, interval) * self.poll_backoff)
+        if interval != self._poll_intervals.get(name):
+            logger.debug(f"Poll user {name} every {interval:.0f}s")
+
+        self._poll_intervals[name] = interval
+        # Jitter keeps users with the same cadence from being polled together.
+        self._next_poll[name] = datetime.datetime.utcnow() + datetime.timedelta(
+            seconds=interval * random.uniform(0.9, 1.1)
+        )
+
+    # Called by the interface when a user registered, logged in again or was deleted.
+    def notify(self, name: str) -> None:
+        self._poll_intervals.pop(name, None)
+        self._next_poll[name] = datetime.datetime.utcnow()
+        if self._wait_fut is not None:
+            self._wait_fut.cancel()
+
+    def cadence(self) -> dict[str, float]:
+        return dict(self._poll_intervals)
+
+    def queue_depths(self) -> dict[str, int]:
+        return self.export_queue.depths()
+
+    # The p50 and p99 time in seconds from finding tagged articles to sending them, over the recently sent jobs.
+    def latency(self) -> tuple[float, float] | None:
+        if not self._latencies:
+            return None
+        if len(self._latencies) == 1:
+            return self._latencies[0], self._latencies[0]
+
+        quantiles = statistics.quantiles(self._latencies, n=100, method="inclusive")
+        return quantiles[49], quantiles[98]
+
+    async def schedule(self) -> None:
+        now = datetime.datetime.utcnow()
+        async with self.sessionmaker() as session:
+            logger.debug("Start consume run")
+            users = [
+                name
+                for name in await session.scalars(select(User.name).where(User.active == True))
+                if self.leases.owns(name)
+            ]
+
+            # Jobs left over by a previous run, including those interrupted while sending, and jobs due for a
+            # retry. A job which was being sent when the consumer stopped is sent again, once it was left alone for a
+            # lease: the previous owner of the partition may still be sending it. Jobs left without a user by older
+            # versions are skipped.
+            pending: defaultdict[str, list[int]] = defaultdict(list)
+            due = await session.scalars(
+                select(Job)
+                .join(Job.user)
+                .options(contains_eager(Job.user))
+                .where(
+                    Job.state.in_(ACTIVE_STATES),
+                    or_(Job.next_attempt_at.is_(None), Job.next_attempt_at <= now),
+                    or_(Job.state.not_in(BUSY_STATES), Job.changed_at <= now - self.leases.ttl),
+                )
+            )
+            for job in due:
+                if job.id not in self._in_flight and self.leases.owns(job.user.name):
+                    pending[job.user.name].append(job.id)
+
+            await session.execute(
+                delete(Job).where(Job.state.in_(("sent", "failed")), Job.changed_at < now - self.job_retention)
+            )
+            await session.commit()
+
+        for ids in pending.values():
+            self._in_flight.update(ids)
+        for name, ids in pending.items():
+            await self._queue_exports(name, ids)
+
+        for name in self._next_poll.keys() - set(users):
+            del self._next_poll[name]
+            self._poll_intervals.pop(name, None)
+
+        for name in users:
+            if name not in self._next_poll:
+                # Spread users seen for the first time over one interval.
+                self._next_poll[name] = now + datetime.timedelta(seconds=random.uniform(0, self.poll_interval))
+            if name not in self._fetching and self._next_poll[name] <= now:
+                self._fetching.add(name)
+                await self.fetch_queue.put(name)
 
     async def _wait_since(self, since: datetime.datetime) -> None:
         now = datetime.datetime.utcnow()
-        wait = max(0.0, self.interval - (now - since).total_seconds())
+        wait = self.interval - (now - since).total_seconds()
+        next_poll = min((t for name, t in self._next_poll.items() if name not in self._fetching), default=None)
+        if next_poll is not None:
+            wait = min(wait, (next_poll - now).total_seconds())
+        wait = max(0.0, wait)
 
         if not self.running:
             return
@@ -52,21 +520,98 @@ class Consumer:
         finally:
             self._wait_fut = None
 
-    async def consume(self) -> None:
-        while self.running:
-            start = datetime.datetime.utcnow()
+    def _log_stats(self) -> None:
+        logger.debug(
+            f"Consumer {self.leases.owner} holds {len(self.leases.owned)} of {self.leases.partitions} partitions "
+            f"shared by {self.leases.consumers} consumers"
+        )
+        if self._poll_intervals:
+            intervals = sorted(self._poll_intervals.values())
+            fastest = sum(interval <= self.poll_interval for interval in intervals)
+            logger.debug(
+                f"Polling {len(intervals)} users: {fastest} every {self.poll_interval}s, "
+                f"median every {intervals[len(intervals) // 2]:.0f}s, slowest every {intervals[-1]:.0f}s"
+            )
+        logger.debug(
+            f"Queues: {self.fetch_queue.qsize()} users to fetch, {self.export_queue.qsize()} exports, "
+            f"{self.send_queue.qsize()} mails waiting"
+        )
+        depths = sorted(self.queue_depths().items(), key=lambda depth: depth[1], reverse=True)
+        if depths:
+            deepest = ", ".join(f"{name} {depth}" for name, depth in depths[:5])
+            logger.debug(f"Jobs waiting for an export of {len(depths)} users, deepest: {deepest}")
+        latency = self.latency()
+        if latency is not None:
+            logger.debug(
+                f"Time from tag to send of the last {len(self._latencies)} jobs: p50 {latency[0]:.0f}s, "
+                f"p99 {latency[1]:.0f}s"
+            )
+        stats = self.wallabag.stats
+        logger.debug(
+            f"Wallabag client made {stats.requests} requests on {stats.connections_opened} connections "
+            f"({stats.connections_reused} reused)"
+        )
+        logger.debug(
+            f"Removed tags with {stats.tag_requests_saved - self._tag_requests_saved} requests less than one per tag "
+            f"this cycle, {stats.tag_requests_saved} in total"
+        )
+        self._tag_requests_saved = stats.tag_requests_saved
+        pool = self.pool_stats
+        logger.debug(
+            f"Database pool: {pool.in_use} connections in use, peak {pool.peak}, {pool.connections_opened} opened, "
+            f"{pool.checkouts} checkouts held {pool.hold_time:.1f}s in total"
+        )
+        if self.wallabag.cache is not None:
+            cache = self.wallabag.cache
+            logger.debug(f"Export cache: {cache.hits} hits, {cache.misses} misses, {cache.evictions} evictions")
+        for limit in self.scheduler.stats():
+            logger.debug(
+                f"Limit {limit.name}: {limit.in_use}/{limit.size} in use, peak {limit.peak}, "
+                f"{limit.waiting} waiting, {limit.wait_time:.1f}s waited for {limit.acquired} slots"
+            )
+        if self.wallabag.budget is not None:
+            budget = self.wallabag.budget.stats()
+            logger.debug(
+                f"Byte budget: {budget.in_use / 1024 / 1024:.1f} of {budget.size / 1024 / 1024:.0f} MB in use "
+                f"({budget.saturation:.0%}), peak {budget.peak / 1024 / 1024:.1f} MB, {budget.waiting} waiting, "
+                f"{budget.wait_time:.1f}s waited for {budget.acquired} reservations"
+            )
 
-            with self.sessionmaker as session:
-                logger.debug("Start consume run")
-                fetches = [self.fetch_jobs(user) for user in session.query(User).filter(User.active == True).all()]
-                await asyncio.gather(*fetches)
-                session.commit()
+    async def _heartbeat(self) -> None:
+        # Renewed several times per lease, a renewal failing once doesn't lose the partitions.
+        while True:
+            await asyncio.sleep(self.leases.ttl.total_seconds() / 3)
+            try:
+                await self.leases.renew()
+            except Exception:
+                logger.exception("Failed to renew the partition leases")
 
-                jobs = [self.process_job(job, session) for job in session.query(Job).options(joinedload(Job.user))]
-                await asyncio.gather(*jobs)
-                session.commit()
+    async def consume(self) -> None:
+        await self.leases.renew()
+        heartbeat = asyncio.ensure_future(self._heartbeat())
+        fetchers = self._workers("Fetch", self.fetch_queue, self._fetch_user, self.fetch_workers)
+        exporters = self._workers("Export", self.export_queue, self.export_jobs, self.export_workers)
+        senders = self._workers("Send", self.send_queue, self.send_jobs, self.send_workers)
+
+        try:
+            while self.running:
+                start = datetime.datetime.utcnow()
+                await self.schedule()
+                self._log_stats()
+                await self._wait_since(start)
+        finally:
+            self.running = False
+            # Only the items being handled are finished. The queued ones are dropped, their jobs are kept in the
+            # database and resumed by the next run. The senders keep taking the mails of the exports finishing.
+            self._drop_sends()
+            await self._stop_workers({"Fetch", "Export"}, fetchers + exporters)
+            await self._stop_workers({"Send"}, senders)
+            self._drop_sends()
 
-            await self._wait_since(start)
+            heartbeat.cancel()
+            await asyncio.gather(heartbeat, return_exceptions=True)
+            # Hand the partitions over right away instead of letting their leases expire.
+            await self.leases.release()
 
     def stop(self) -> None:
         self.running = False
@@ -1,16 +1,17 @@
 import asyncio
 import os
-from collections.abc import Mapping
+from collections.abc import Callable, Mapping
 from typing import Any
 
 import aiohttp_jinja2
 import jinja2
 from aiohttp import web
 from email_validator import EmailNotValidError, ValidatedEmail, validate_email
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
 
 from wallabag_kindle_consumer.logger import logger
 
-from . import config, models, wallabag
+from . import config, metrics, models, wallabag
 
 
 class Validator:
@@ -108,8 +109,12 @@ class ViewBase(web.View):
     def _add_message(self, msg: str) -> None:
         self._messages.append(msg)
 
+    def _user_changed(self, name: str) -> None:
+        for listener in self.request.app["user_listeners"]:
+            listener(name)
+
     @property
-    def _session(self) -> models.ContextSession:
+    def _session(self) -> async_sessionmaker[AsyncSession]:
         return self.request.app["session_maker"]
 
 
@@ -133,14 +138,15 @@ class IndexView(ViewBase):
                 name=validator.username, kindle_mail=validator.kindle_email, email=validator.notify_email
             )
 
-            with self._session as session:
-                if session.query(models.User.name).filter(models.User.name == validator.username).count() != 0:
+            async with self._session() as session:
+                if await session.get(models.User, validator.username) is not None:
                     self._add_errors({"user": "User is already registered"})
                 elif not await self._wallabag.get_token(user, validator.password):
                     self._add_errors({"auth": "Cannot authenticate at wallabag server to get a token"})
                 else:
                     session.add(user)
-                    session.commit()
+                    await session.commit()
+                    self._user_changed(validator.username)
                     self._add_message(f"User {validator.username} successfully registered")
                     self._set_data({})
                     logger.info(f"User {validator.username} registered")
@@ -163,14 +169,15 @@ class ReLoginView(ViewBase):
         self._add_errors(validator.errors)
 
         if validator.success:
-            with self._session as session:
-                user = session.query(models.User).filter(models.User.name == validator.username).first()
+            async with self._session() as session:
+                user = await session.get(models.User, validator.username)
                 if user is None:
                     self._add_errors({"user": "User not registered"})
                 else:
                     if await self._wallabag.get_token(user, validator.password):
                         user.active = True
-                        session.commit()
+                        await session.commit()
+                        self._user_changed(validator.username)
                         self._add_message(f"User {validator.username} successfully updated.")
                         logger.info(f"User {user} successfully updated.")
                     else:
@@ -194,14 +201,15 @@ class DeleteView(ViewBase):
         self._add_errors(validator.errors)
 
         if validator.success:
-            with self._session as session:
-                user = session.query(models.User).filter(models.User.name == validator.username).first()
+            async with self._session() as session:
+                user = await session.get(models.User, validator.username)
                 if user is None:
                     self._add_errors({"user": "User not registered"})
                 else:
                     if await self._wallabag.get_token(user, validator.password):
-                        session.delete(user)
-                        session.commit()
+                        await session.delete(user)
+                        await session.commit()
+                        self._user_changed(validator.username)
                         self._add_message(f"User {validator.username} successfully deleted.")
                         logger.info(f"User {user} successfully deleted.")
                     else:
@@ -211,9 +219,15 @@ class DeleteView(ViewBase):
 
 
 class App:
-    def __init__(self, config: config.Configuration, wallabag: wallabag.Wallabag):
+    def __init__(
+        self,
+        config: config.Configuration,
+        wallabag: wallabag.Wallabag,
+        user_listeners: list[Callable[[str], None]] | None = None,
+    ):
         self.config = config
         self.wallabag = wallabag
+        self.user_listeners = user_listeners or []
         self.app = web.Application()
         self.site: web.TCPSite | None = None
 
@@ -223,7 +237,8 @@ class App:
     def setup_app(self) -> None:
         self.app["config"] = self.config
         self.app["wallabag"] = self.wallabag
-        self.app["session_maker"] = models.context_session(self.config)
+        self.app["user_listeners"] = self.user_listeners
+        self.app["session_maker"] = models.session_maker(self.config)
         aiohttp_jinja2.setup(self.app, loader=jinja2.PackageLoader("wallabag_kindle_consumer", "templates"))
 
         self.app["static_root_url"] = "/static"
@@ -233,6 +248,8 @@ class App:
         self.app.router.add_view("/", IndexView)
         self.app.router.add_view("/delete", DeleteView)
         self.app.router.add_view("/update", ReLoginView)
+        if self.config.metrics:
+            self.app.router.add_get("/metrics", metrics.handle)
 
     def run(self) -> None:
         web.run_app(self.app, host=self.config.interface_host, port=self.config.interface_port)
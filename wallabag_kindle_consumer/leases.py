@@ -0,0 +1,110 @@
+import math
+import os
+import socket
+import uuid
+import zlib
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, or_, select, update
+
+from wallabag_kindle_consumer.config import Configuration
+from wallabag_kindle_consumer.logger import logger
+from wallabag_kindle_consumer.models import Heartbeat, Lease, insert_ignore, session_maker
+
+
+# Users are split into a fixed number of partitions by the hash of their name. Every consumer leases its share of
+# the partitions for a while and renews the leases well before they expire. Partitions of a consumer which stopped
+# renewing them are taken over by the others once they expired.
+class Leases:
+    def __init__(self, config: Configuration):
+        self.sessionmaker = session_maker(config)
+        self.partitions = config.lease_partitions
+        self.ttl = timedelta(seconds=config.lease_ttl)
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+        self.owned: frozenset[int] = frozenset()
+        # When the owned leases expire unless renewed, then other consumers may have taken them over.
+        self.expires_at: datetime | None = None
+        self.consumers = 1
+
+    def partition(self, name: str) -> int:
+        return zlib.crc32(name.encode()) % self.partitions
+
+    def owns(self, name: str) -> bool:
+        if self.expires_at is None or self.expires_at <= datetime.utcnow():
+            return False
+        return self.partition(name) in self.owned
+
+    async def _ensure_partitions(self) -> None:
+        async with self.sessionmaker() as session:
+            count = len(list(await session.scalars(select(Lease.partition))))
+            if count < self.partitions:
+                stmt = insert_ignore(session.get_bind().dialect.name, Lease)
+                await session.execute(stmt, [{"partition": partition} for partition in range(self.partitions)])
+                await session.commit()
+
+    async def renew(self) -> None:
+        if not self.owned:
+            await self._ensure_partitions()
+
+        now = datetime.utcnow()
+        expires_at = now + self.ttl
+        async with self.sessionmaker() as session:
+            await session.execute(
+                delete(Heartbeat).where(or_(Heartbeat.owner == self.owner, Heartbeat.expires_at <= now))
+            )
+            session.add(Heartbeat(owner=self.owner, expires_at=expires_at))
+            await session.flush()
+
+            self.consumers = len(list(await session.scalars(select(Heartbeat.owner))))
+            leases = list(await session.scalars(select(Lease).where(Lease.partition < self.partitions)))
+            share = math.ceil(self.partitions / self.consumers)
+
+            mine = sorted(lease.partition for lease in leases if lease.owner == self.owner)
+            keep, release = mine[:share], mine[share:]
+            free = [
+                lease.partition
+                for lease in leases
+                if lease.owner != self.owner
+                and (lease.owner is None or not lease.expires_at or lease.expires_at <= now)
+            ]
+
+            # Only leases still held are renewed, one may have expired and been taken over meanwhile.
+            await session.execute(
+                update(Lease).where(Lease.partition.in_(keep), Lease.owner == self.owner).values(expires_at=expires_at)
+            )
+            # Surplus partitions are handed back, so consumers which just started get their share. They are no longer
+            # owned here before another consumer can claim them.
+            self.owned = self.owned - set(release)
+            await session.execute(
+                update(Lease).where(Lease.partition.in_(release), Lease.owner == self.owner).values(owner=None)
+            )
+            for partition in free[: share - len(keep)]:
+                # Claimed only if still free, another consumer may claim the same partition at the same time.
+                await session.execute(
+                    update(Lease)
+                    .where(
+                        Lease.partition == partition,
+                        or_(Lease.owner.is_(None), Lease.expires_at.is_(None), Lease.expires_at <= now),
+                    )
+                    .values(owner=self.owner, expires_at=expires_at)
+                )
+            await session.commit()
+
+            owned = frozenset(await session.scalars(select(Lease.partition).where(Lease.owner == self.owner)))
+
+        if owned != self.owned:
+            logger.info(
+                f"Consumer {self.owner} holds {len(owned)} of {self.partitions} partitions, "
+                f"{self.consumers} consumers running"
+            )
+        self.owned = owned
+        self.expires_at = expires_at
+
+    async def release(self) -> None:
+        async with self.sessionmaker() as session:
+            await session.execute(update(Lease).where(Lease.owner == self.owner).values(owner=None, expires_at=None))
+            await session.execute(delete(Heartbeat).where(Heartbeat.owner == self.owner))
+            await session.commit()
+        self.owned = frozenset()
+        self.expires_at = None
@@ -0,0 +1,81 @@
+import base64
+import contextlib
+import uuid
+from collections.abc import Iterator
+from email import policy
+from email.mime.base import MIMEBase
+from email.mime.text import MIMEText
+from email.utils import formatdate, make_msgid
+from typing import IO
+
+# A multiple of 57 bytes encodes to complete 76 character base64 lines.
+CHUNK_SIZE = 57 * 1024
+
+
+# Iterating a message yields it serialized chunk by chunk, the attachments are read and encoded
+# while the message is sent. It can be iterated again, e.g. to retry sending it.
+class Message:
+    def __init__(self, from_addr: str, to_addr: str, subject: str, text: str):
+        self.boundary = f"==============={uuid.uuid4().hex}=="
+        self.headers = {
+            "Content-Type": f'multipart/mixed; boundary="{self.boundary}"',
+            "MIME-Version": "1.0",
+            "Subject": subject,
+            "From": from_addr,
+            "To": to_addr,
+            "Date": formatdate(localtime=True),
+            "Message-ID": make_msgid("wallabag-kindle"),
+        }
+        self.text = text
+        self.attachments: list[tuple[str, IO[bytes]]] = []
+
+    def attach(self, filename: str, data: IO[bytes]) -> None:
+        self.attachments.append((filename, data))
+
+    def __iter__(self) -> Iterator[bytes]:
+        # Folded as str, non-ASCII values like article titles are RFC 2047 encoded.
+        yield "".join(
+            policy.SMTP.header_factory(name, value).fold(policy=policy.SMTP) for name, value in self.headers.items()
+        ).encode("ascii")
+
+        yield f"\r\n--{self.boundary}\r\n".encode()
+        yield MIMEText(self.text).as_bytes(policy=policy.SMTP)
+
+        for filename, data in self.attachments:
+            part = MIMEBase("application", "octet-stream")
+            part["Content-Transfer-Encoding"] = "base64"
+            part.add_header("Content-Disposition", "attachment", filename=filename)
+            yield f"\r\n--{self.boundary}\r\n".encode() + part.as_bytes(policy=policy.SMTP)
+
+            data.seek(0)
+            while chunk := data.read(CHUNK_SIZE):
+                yield base64.encodebytes(chunk).replace(b"\n", b"\r\n")
+
+        yield f"\r\n--{self.boundary}--\r\n".encode()
+
+    def write(self, out: IO[bytes]) -> None:
+        for chunk in self:
+            out.write(chunk)
+
+
+# Renders a message into a file, run by a worker process of the sender. Only paths cross the process boundary, the
+# attachments are read from and the rendered message is written to files.
+def render(from_addr: str, to_addr: str, subject: str, text: str, attachments: list[tuple[str, str]], out: str) -> int:
+    msg = Message(from_addr, to_addr, subject, text)
+    with contextlib.ExitStack() as stack:
+        for filename, path in attachments:
+            msg.attach(filename, stack.enter_context(open(path, "rb")))
+        with open(out, "wb") as f:
+            msg.write(f)
+            return f.tell()
+
+
+# A message rendered by render, iterating it yields the file chunk by chunk.
+class RenderedMessage:
+    def __init__(self, data: IO[bytes]):
+        self.data = data
+
+    def __iter__(self) -> Iterator[bytes]:
+        self.data.seek(0)
+        while chunk := self.data.read(CHUNK_SIZE):
+            yield chunk
@@ -0,0 +1,174 @@
+import asyncio
+import bisect
+import time
+from collections.abc import Callable, Iterable, Iterator
+
+from aiohttp import web
+
+from wallabag_kindle_consumer.config import Configuration
+from wallabag_kindle_consumer.logger import logger
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+SIZE_BUCKETS = tuple(float(2**i * 1024) for i in range(4, 18, 2))
+LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+LOOP_LAG_INTERVAL = 0.5
+
+Labels = dict[str, str]
+Sample = tuple[str, Labels, float]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_sample(name: str, labels: Labels, value: float) -> str:
+    if labels:
+        name += "{" + ",".join(f'{key}="{_escape(label)}"' for key, label in labels.items()) + "}"
+    return f"{name} {value!r}"
+
+
+# Collects nothing unless enabled, the instruments then return right away.
+class Registry:
+    def __init__(self) -> None:
+        self.enabled = False
+        self._metrics: dict[str, "Counter | Histogram"] = {}
+        # Gauges are read when scraped, from the objects which know their value anyway.
+        self._gauges: dict[str, tuple[str, Callable[[], Iterable[tuple[Labels, float]]]]] = {}
+
+    def register(self, metric: "Counter | Histogram") -> None:
+        self._metrics[metric.name] = metric
+
+    def gauge(self, name: str, help: str, collect: Callable[[], Iterable[tuple[Labels, float]]]) -> None:
+        self._gauges[name] = (help, collect)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines += [f"# HELP {metric.name} {metric.help}", f"# TYPE {metric.name} {metric.type}"]
+            lines += [_format_sample(*sample) for sample in metric.samples()]
+        for name, (help, collect) in self._gauges.items():
+            lines += [f"# HELP {name} {help}", f"# TYPE {name} gauge"]
+            try:
+                lines += [_format_sample(name, labels, value) for labels, value in collect()]
+            except Exception:
+                logger.exception(f"Failed to collect metric {name}")
+        return "\n".join(lines) + "\n"
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, registry: Registry, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values: dict[tuple[str, ...], float] = {}
+        registry.register(self)
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        if not self.registry.enabled:
+            return
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self) -> Iterator[Sample]:
+        for labels, value in self.values.items():
+            yield self.name, dict(zip(self.labels, labels)), value
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(
+        self, registry: Registry, name: str, help: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = ()
+    ):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets or LATENCY_BUCKETS
+        # The observations per bucket, the last one counts those above all buckets, and their sum.
+        self.counts: dict[tuple[str, ...], list[int]] = {}
+        self.sums: dict[tuple[str, ...], float] = {}
+        registry.register(self)
+
+    def observe(self, value: float, *labels: str) -> None:
+        if not self.registry.enabled:
+            return
+        if labels not in self.counts:
+            self.counts[labels] = [0] * (len(self.buckets) + 1)
+            self.sums[labels] = 0.0
+        self.counts[labels][bisect.bisect_left(self.buckets, value)] += 1
+        self.sums[labels] += value
+
+    def samples(self) -> Iterator[Sample]:
+        for labels, counts in self.counts.items():
+            named = dict(zip(self.labels, labels))
+            total = 0
+            for bound, count in zip((*self.buckets, float("inf")), counts):
+                total += count
+                yield f"{self.name}_bucket", {**named, "le": "+Inf" if bound == float("inf") else repr(bound)}, total
+            yield f"{self.name}_sum", named, self.sums[labels]
+            yield f"{self.name}_count", named, total
+
+
+REGISTRY = Registry()
+
+WALLABAG_REQUESTS = Histogram(
+    REGISTRY,
+    "wallabag_kindle_wallabag_request_duration_seconds",
+    "Duration of requests to wallabag until the response headers arrived.",
+    ("method", "endpoint", "status"),
+)
+EXPORT_SIZE = Histogram(
+    REGISTRY, "wallabag_kindle_export_size_bytes", "Size of the exported articles.", ("format",), SIZE_BUCKETS
+)
+EXPORT_DURATION = Histogram(
+    REGISTRY, "wallabag_kindle_export_duration_seconds", "Duration of the article exports.", ("format",)
+)
+SMTP_CONNECT = Histogram(
+    REGISTRY, "wallabag_kindle_smtp_connect_duration_seconds", "Duration of opening SMTP connections.", ("outcome",)
+)
+SMTP_SEND = Histogram(
+    REGISTRY, "wallabag_kindle_smtp_send_duration_seconds", "Duration of sending mails.", ("outcome",)
+)
+JOBS = Counter(REGISTRY, "wallabag_kindle_jobs_total", "Jobs created, sent and given up.", ("event",))
+REFRESHES = Counter(
+    REGISTRY, "wallabag_kindle_token_refreshes_total", "Outcomes of refreshing tokens of users.", ("outcome",)
+)
+LOOP_LAG = Histogram(
+    REGISTRY, "wallabag_kindle_event_loop_lag_seconds", "Delay of the event loop waking up.", (), LAG_BUCKETS
+)
+
+
+async def monitor_loop_lag() -> None:
+    while True:
+        start = time.monotonic()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        LOOP_LAG.observe(max(0.0, time.monotonic() - start - LOOP_LAG_INTERVAL))
+
+
+async def handle(request: web.Request) -> web.Response:
+    return web.Response(body=REGISTRY.render().encode(), headers={"Content-Type": CONTENT_TYPE})
+
+
+# Serves the metrics on their own port when the web interface doesn't run in the process.
+class MetricsServer:
+    def __init__(self, config: Configuration):
+        self.config = config
+        self.app = web.Application()
+        self.app.router.add_get("/metrics", handle)
+        self.site: web.TCPSite | None = None
+
+    async def register_server(self) -> None:
+        app_runner = web.AppRunner(self.app, access_log=None)
+        await app_runner.setup()
+        self.site = web.TCPSite(app_runner, self.config.interface_host, self.config.metrics_port)
+        await self.site.start()
+
+    def stop(self) -> None:
+        if self.site is not None:
+            asyncio.get_event_loop().create_task(self.site.stop())
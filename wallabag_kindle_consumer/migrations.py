@@ -0,0 +1,99 @@
+from collections.abc import Callable
+
+from sqlalchemy import Column, Connection, DateTime, Integer, String, delete, func, inspect, select, text, update
+
+from wallabag_kindle_consumer.config import Configuration
+from wallabag_kindle_consumer.logger import logger
+from wallabag_kindle_consumer.models import ACTIVE_JOB, SCHEMA_VERSION, Base, Job, engine, schema_version
+
+# Databases created before the schema was versioned have the tables of version 1.
+BASELINE_VERSION = 1
+
+
+def _add_column(conn: Connection, table: str, column: Column, default: str | None = None) -> None:
+    # Columns may exist already when the database was created by a later release with create_db.
+    if column.name in {c["name"] for c in inspect(conn).get_columns(table)}:
+        return
+
+    quote = conn.dialect.identifier_preparer.quote
+    ddl = f"ALTER TABLE {quote(table)} ADD COLUMN {quote(column.name)} {column.type.compile(conn.dialect)}"
+    if default is not None:
+        ddl += f" NOT NULL DEFAULT {default}"
+    conn.execute(text(ddl))
+
+
+def _job_updated_at(conn: Connection) -> None:
+    _add_column(conn, "job", Column("updated_at", String))
+
+
+def _job_state(conn: Connection) -> None:
+    _add_column(conn, "job", Column("state", Job.__table__.c.state.type), "'pending'")
+    _add_column(conn, "job", Column("attempts", Integer), "0")
+    _add_column(conn, "job", Column("next_attempt_at", DateTime))
+    _add_column(conn, "job", Column("export_path", String))
+    # SQLite can't add a column with a non constant default, so existing jobs are updated instead.
+    _add_column(conn, "job", Column("changed_at", DateTime))
+    conn.execute(update(Job).where(Job.changed_at.is_(None)).values(changed_at=func.now()))
+
+
+def _indexes(conn: Connection) -> None:
+    # Keep the oldest of duplicated jobs, the unique index can't be created otherwise.
+    first = select(func.min(Job.id)).where(text(ACTIVE_JOB)).group_by(Job.user_name, Job.article, Job.format)
+    conn.execute(delete(Job).where(text(ACTIVE_JOB), Job.id.not_in(first.scalar_subquery())))
+
+    for table in ("user", "job"):
+        for index in Base.metadata.tables[table].indexes:
+            index.create(conn, checkfirst=True)
+
+
+def _leases(conn: Connection) -> None:
+    for table in ("lease", "heartbeat"):
+        Base.metadata.tables[table].create(conn, checkfirst=True)
+
+
+def _job_created_at(conn: Connection) -> None:
+    # Jobs of earlier releases count as created when they were last changed.
+    _add_column(conn, "job", Column("created_at", DateTime))
+    conn.execute(update(Job).where(Job.created_at.is_(None)).values(created_at=Job.changed_at))
+
+
+# The steps upgrading a database to the version they are keyed with.
+MIGRATIONS: dict[int, Callable[[Connection], None]] = {
+    2: _job_updated_at,
+    3: _job_state,
+    4: _indexes,
+    5: _leases,
+    6: _job_created_at,
+}
+assert max(MIGRATIONS) == SCHEMA_VERSION
+
+
+def _current_version(conn: Connection) -> int | None:
+    tables = inspect(conn).get_table_names()
+    if "job" not in tables:
+        return None
+    if "schema_version" not in tables:
+        return BASELINE_VERSION
+    return conn.execute(select(schema_version.c.version)).scalar_one_or_none() or BASELINE_VERSION
+
+
+def _migrate(conn: Connection) -> tuple[int | None, int]:
+    version = _current_version(conn)
+    if version is None:
+        Base.metadata.create_all(conn)
+    else:
+        schema_version.create(conn, checkfirst=True)
+        for target in range(version + 1, SCHEMA_VERSION + 1):
+            logger.info(f"Migrate database to version {target}")
+            MIGRATIONS[target](conn)
+
+    conn.execute(schema_version.delete())
+    conn.execute(schema_version.insert().values(version=SCHEMA_VERSION))
+    return version, SCHEMA_VERSION
+
+
+async def migrate_db(config: Configuration) -> tuple[int | None, int]:
+    # All steps run in one transaction, so a failed migration leaves the database untouched where the DDL is
+    # transactional (SQLite, PostgreSQL).
+    async with engine(config).begin() as conn:
+        return await conn.run_sync(_migrate)
@@ -1,8 +1,27 @@
+import dataclasses
 import datetime
-from types import TracebackType
-
-from sqlalchemy import Enum, ForeignKey, create_engine
-from sqlalchemy.orm import DeclarativeBase, Mapped, Session, mapped_column, relationship, sessionmaker
+import time
+from typing import Any
+
+from sqlalchemy import (
+    Column,
+    Connection,
+    Enum,
+    ForeignKey,
+    Index,
+    Insert,
+    Integer,
+    Table,
+    event,
+    insert,
+    inspect,
+    make_url,
+    text,
+)
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
+from sqlalchemy.pool import ConnectionPoolEntry
 
 from wallabag_kindle_consumer.config import Configuration
 
@@ -11,8 +30,18 @@ class Base(DeclarativeBase):
     ...
 
 
+# Bumped with every migration in migrations.py.
+SCHEMA_VERSION = 6
+
+schema_version = Table("schema_version", Base.metadata, Column("version", Integer, nullable=False))
+
+# Finished jobs are kept for a while, the same article may be queued again meanwhile.
+ACTIVE_JOB = "state NOT IN ('sent', 'failed')"
+
+
 class User(Base):
     __tablename__ = "user"
+    __table_args__ = (Index("ix_user_active_token_valid", "active", "token_valid"),)
 
     name: Mapped[str] = mapped_column(primary_key=True)
     token: Mapped[str | None]
@@ -24,52 +53,185 @@ class User(Base):
     kindle_mail: Mapped[str]
     active: Mapped[bool] = mapped_column(default=True)
 
-    jobs: Mapped[list["Job"]] = relationship(back_populates="user")
+    # The jobs of a deleted user go with it, there is nobody left to send them to.
+    jobs: Mapped[list["Job"]] = relationship(back_populates="user", cascade="all, delete-orphan")
 
 
 class Job(Base):
     __tablename__ = "job"
+    __table_args__ = (
+        Index("ix_job_user_name", "user_name"),
+        Index("ix_job_state_next_attempt_at", "state", "next_attempt_at"),
+        Index(
+            "uq_job_user_name_article_format",
+            "user_name",
+            "article",
+            "format",
+            unique=True,
+            sqlite_where=text(ACTIVE_JOB),
+            postgresql_where=text(ACTIVE_JOB),
+        ),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     article: Mapped[int]
     title: Mapped[str]
+    updated_at: Mapped[str | None]
     user_name: Mapped[int | None] = mapped_column(ForeignKey("user.name"))
     format = mapped_column(Enum("pdf", "mobi", "epub"))
+    state = mapped_column(
+        Enum("pending", "exporting", "exported", "sending", "sent", "failed"), nullable=False, default="pending"
+    )
+    attempts: Mapped[int] = mapped_column(default=0)
+    next_attempt_at: Mapped[datetime.datetime | None]
+    export_path: Mapped[str | None]
+    changed_at: Mapped[datetime.datetime] = mapped_column(default=datetime.datetime.utcnow)
+    created_at: Mapped[datetime.datetime] = mapped_column(default=datetime.datetime.utcnow)
 
     user: Mapped["User"] = relationship(back_populates="jobs")
 
 
-class ContextSession:
-    def __init__(self, session_maker: sessionmaker[Session]):
-        self.session_maker = session_maker
+# Consumers share the users by hash partitions, each leased by one consumer until it expires.
+class Lease(Base):
+    __tablename__ = "lease"
+
+    partition: Mapped[int] = mapped_column(primary_key=True, autoincrement=False)
+    owner: Mapped[str | None]
+    expires_at: Mapped[datetime.datetime | None]
+
+
+# The running consumers, a consumer which stopped renewing its heartbeat no longer gets a share of the partitions.
+class Heartbeat(Base):
+    __tablename__ = "heartbeat"
+
+    owner: Mapped[str] = mapped_column(primary_key=True)
+    expires_at: Mapped[datetime.datetime]
+
+
+# Async drivers used for database URIs without an explicit driver.
+ASYNC_DRIVERS = {"sqlite": "sqlite+aiosqlite", "postgresql": "postgresql+asyncpg"}
+
+
+def async_uri(uri: str) -> str:
+    url = make_url(uri)
+    return url.set(drivername=ASYNC_DRIVERS.get(url.drivername, url.drivername)).render_as_string(hide_password=False)
+
+
+@dataclasses.dataclass
+class PoolStats:
+    connections_opened: int = 0
+    checkouts: int = 0
+    in_use: int = 0
+    peak: int = 0
+    hold_time: float = 0.0
+
+
+# One engine per database for the whole process, shared by all roles.
+_engines: dict[str, AsyncEngine] = {}
+_pool_stats: dict[str, PoolStats] = {}
+
+
+def _sqlite_pragmas(config: Configuration) -> list[str]:
+    pragmas = [f"PRAGMA busy_timeout = {config.sqlite_busy_timeout}"]
+    if config.sqlite_wal:
+        # NORMAL is durable in WAL mode except for the last transactions on a power loss.
+        pragmas += ["PRAGMA journal_mode = WAL", "PRAGMA synchronous = NORMAL"]
+    if config.sqlite_mmap_size:
+        pragmas.append(f"PRAGMA mmap_size = {config.sqlite_mmap_size * 1024 * 1024}")
+    return pragmas
+
+
+def _track_pool(engine: AsyncEngine, stats: PoolStats) -> None:
+    def connect(dbapi_connection: Any, record: ConnectionPoolEntry) -> None:
+        stats.connections_opened += 1
+
+    def checkout(dbapi_connection: Any, record: ConnectionPoolEntry, proxy: Any) -> None:
+        record.info["checked_out"] = time.monotonic()
+        stats.checkouts += 1
+        stats.in_use += 1
+        stats.peak = max(stats.peak, stats.in_use)
+
+    def checkin(dbapi_connection: Any, record: ConnectionPoolEntry) -> None:
+        if "checked_out" in record.info:
+            stats.hold_time += time.monotonic() - record.info.pop("checked_out")
+            stats.in_use -= 1
+
+    event.listen(engine.sync_engine, "connect", connect)
+    event.listen(engine.sync_engine, "checkout", checkout)
+    event.listen(engine.sync_engine, "checkin", checkin)
+
+
+def engine(config: Configuration) -> AsyncEngine:
+    uri = async_uri(config.db_uri)
+    if uri in _engines:
+        return _engines[uri]
+
+    url = make_url(uri)
+    kwargs: dict[str, Any] = {}
+    # In memory SQLite databases use a single static connection without a pool to size.
+    if url.get_backend_name() != "sqlite" or url.database not in (None, "", ":memory:"):
+        kwargs.update(
+            pool_size=config.db_pool_size, max_overflow=config.db_max_overflow, pool_timeout=config.db_pool_timeout
+        )
+    _engines[uri] = create_async_engine(uri, **kwargs)
+    _pool_stats[uri] = PoolStats()
+    _track_pool(_engines[uri], _pool_stats[uri])
+
+    if url.get_backend_name() == "sqlite":
+        pragmas = _sqlite_pragmas(config)
+
+        @event.listens_for(_engines[uri].sync_engine, "connect")
+        def apply_pragmas(dbapi_connection: Any, record: ConnectionPoolEntry) -> None:
+            cursor = dbapi_connection.cursor()
+            for pragma in pragmas:
+                cursor.execute(pragma)
+            cursor.close()
+
+    return _engines[uri]
+
+
+def pool_stats(config: Configuration) -> PoolStats:
+    engine(config)
+    return _pool_stats[async_uri(config.db_uri)]
+
+
+async def dispose_engines() -> None:
+    for uri in list(_engines):
+        await _engines.pop(uri).dispose()
+        _pool_stats.pop(uri, None)
+
 
-    def __enter__(self) -> Session:
-        self.session = self.session_maker()
-        return self.session
+def session_maker(config: Configuration) -> async_sessionmaker[AsyncSession]:
+    # Attributes are not expired on commit, an async session can't load them implicitly afterwards.
+    return async_sessionmaker(engine(config), expire_on_commit=False)
 
-    def __exit__(
-        self,
-        exc_type: type[BaseException] | None,
-        exc_val: BaseException | None,
-        exc_tb: TracebackType | None,
-    ) -> None:
-        self.session.close()
 
+# An INSERT which skips the rows violating a unique index.
+def insert_ignore(dialect: str, model: type[Base]) -> Insert:
+    if dialect == "sqlite":
+        return sqlite.insert(model).on_conflict_do_nothing()
+    if dialect == "postgresql":
+        return postgresql.insert(model).on_conflict_do_nothing()
+    return insert(model)
 
-def context_session(config: Configuration) -> ContextSession:
-    return ContextSession(session_maker(config))
 
+def _create_all(conn: Connection) -> bool:
+    # An existing database keeps its schema version, stamping it would skip its migrations.
+    if inspect(conn).has_table(Job.__tablename__):
+        return False
 
-def session_maker(config: Configuration) -> sessionmaker[Session]:
-    return sessionmaker(autocommit=False, autoflush=False, bind=create_engine(config.db_uri))
+    Base.metadata.create_all(conn)
+    conn.execute(schema_version.insert().values(version=SCHEMA_VERSION))
+    return True
 
 
-def create_db(config: Configuration) -> None:
-    engine = create_engine(config.db_uri)
-    Base.metadata.create_all(engine)
+async def create_db(config: Configuration) -> bool:
+    async with engine(config).begin() as conn:
+        return await conn.run_sync(_create_all)
 
 
-def re_create_db(config: Configuration) -> None:
-    engine = create_engine(config.db_uri)
-    Base.metadata.drop_all(engine)
-    Base.metadata.create_all(engine)
+async def re_create_db(config: Configuration) -> None:
+    async with engine(config).begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.execute(schema_version.insert().values(version=SCHEMA_VERSION))
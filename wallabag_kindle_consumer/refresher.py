@@ -1,65 +1,128 @@
 import asyncio
+import contextlib
+import heapq
+import random
 from datetime import datetime, timedelta
 
-from sqlalchemy import func
-from sqlalchemy.orm import Session
+from sqlalchemy import select
 
 from wallabag_kindle_consumer.config import Configuration
 from wallabag_kindle_consumer.logger import logger
-from wallabag_kindle_consumer.models import User, context_session
+from wallabag_kindle_consumer.models import User, session_maker
 from wallabag_kindle_consumer.sender import Sender
 from wallabag_kindle_consumer.wallabag import Wallabag
 
+# Users changed by another process (e.g. a separate web interface) are picked up by a full reload this often.
+RELOAD_INTERVAL = 300
+
 
 class Refresher:
     def __init__(self, config: Configuration, wallabag: Wallabag, sender: Sender):
-        self.sessionmaker = context_session(config)
+        self.sessionmaker = session_maker(config)
         self.wallabag = wallabag
         self.grace = config.refresh_grace
+        self.jitter = config.refresh_jitter
         self.sender = sender
         self.config = config
 
         self._running = True
-        self._wait_fut: asyncio.Future[None] | None = None
+        self._wake = asyncio.Event()
+        # A heap of refresh deadlines, entries replaced by a later one are skipped when popped.
+        self._heap: list[tuple[datetime, str]] = []
+        self._deadlines: dict[str, datetime] = {}
+        self._changed: set[str] = set()
+        self._loaded_at = datetime.min
+
+    # Called by the interface when a user registered, logged in again or was deleted.
+    def notify(self, name: str) -> None:
+        self._changed.add(name)
+        self._wake.set()
+
+    def _schedule(self, user: User) -> None:
+        if not user.active:
+            self._deadlines.pop(user.name, None)
+            return
+
+        # Refreshing at a random time within the jitter spreads out tokens which expire together.
+        deadline = user.token_valid - timedelta(seconds=self.grace + random.uniform(0, self.jitter))
+        self._deadlines[user.name] = deadline
+        heapq.heappush(self._heap, (deadline, user.name))
+
+    async def _load(self) -> None:
+        async with self.sessionmaker() as session:
+            users = await session.scalars(select(User).where(User.active == True))
+            self._heap.clear()
+            self._deadlines.clear()
+            for user in users:
+                self._schedule(user)
+        self._loaded_at = datetime.utcnow()
+        logger.debug(f"Scheduled token refreshes for {len(self._deadlines)} users")
+
+    async def _reload_changed(self) -> None:
+        names, self._changed = self._changed, set()
+        async with self.sessionmaker() as session:
+            users = {user.name: user for user in await session.scalars(select(User).where(User.name.in_(names)))}
+        for name in names:
+            if name in users:
+                self._schedule(users[name])
+            else:
+                self._deadlines.pop(name, None)
 
-    def _wait_time(self, session: Session) -> float:
-        next = session.query(func.min(User.token_valid).label("min")).filter(User.active == True).first()
-        if next is None or next.min is None:
-            return 3
-        delta = next.min - datetime.utcnow()
-        if delta < timedelta(seconds=self.grace):
-            return 0
+    def _pop_due(self, now: datetime) -> list[str]:
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            deadline, name = heapq.heappop(self._heap)
+            if self._deadlines.get(name) == deadline:
+                del self._deadlines[name]
+                due.append(name)
+        return due
 
-        calculated = delta - timedelta(seconds=self.grace)
-        return calculated.total_seconds()
+    def _wait_time(self, now: datetime) -> float:
+        wait = RELOAD_INTERVAL - (now - self._loaded_at).total_seconds()
+        while self._heap and self._deadlines.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        if self._heap:
+            wait = min(wait, (self._heap[0][0] - now).total_seconds())
+        return max(0.0, wait)
+
+    async def _wait(self, timeout: float) -> None:
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(self._wake.wait(), timeout)
+        self._wake.clear()
 
     async def refresh(self) -> None:
         while self._running:
-            with self.sessionmaker as session:
-                self._wait_fut = asyncio.ensure_future(asyncio.sleep(self._wait_time(session)))
-                try:
-                    await self._wait_fut
-                except asyncio.CancelledError:
-                    continue
-                finally:
-                    self._wait_fut = None
-
-                ts = datetime.utcnow() + timedelta(seconds=self.grace)
-                refreshes = [
-                    self._refresh_user(user)
-                    for user in session.query(User).filter(User.active == True).filter(User.token_valid < ts).all()
-                ]
-                await asyncio.gather(*refreshes)
-
-                session.commit()
+            now = datetime.utcnow()
+            if (now - self._loaded_at).total_seconds() >= RELOAD_INTERVAL:
+                await self._load()
+            if self._changed:
+                await self._reload_changed()
+
+            due = self._pop_due(now)
+            if due:
+                await self._refresh_users(due)
+                continue
+
+            await self._wait(self._wait_time(now))
+
+    async def _refresh_users(self, names: list[str]) -> None:
+        async with self.sessionmaker() as session:
+            users = list(await session.scalars(select(User).where(User.active == True).where(User.name.in_(names))))
+            # Hand the connection back to the pool while the tokens are refreshed.
+            await session.commit()
+            await asyncio.gather(*(self._refresh_user(user) for user in users))
+
+            await session.commit()
+
+        for user in users:
+            self._schedule(user)
 
     async def _refresh_user(self, user: User) -> None:
         logger.info(f"Refresh token for {user.name}")
-        if not await self.wallabag.refresh_token(user):
+        if not await self.wallabag.refresh_shared(user):
             await self.sender.send_warning(user, self.config)
             user.active = False
 
     def stop(self) -> None:
         self._running = False
-        if self._wait_fut is not None:
-            self._wait_fut.cancel()
+        self._wake.set()
@@ -0,0 +1,257 @@
+import asyncio
+import contextlib
+import dataclasses
+import time
+from collections import deque
+from collections.abc import AsyncIterator
+from typing import Generic, TypeVar
+
+T = TypeVar("T")
+
+
+@dataclasses.dataclass
+class LimitStats:
+    name: str
+    size: int
+    in_use: int
+    waiting: int
+    peak: int
+    acquired: int
+    wait_time: float
+
+    @property
+    def saturation(self) -> float:
+        return self.in_use / self.size if self.size else 0.0
+
+
+class Limit:
+    def __init__(self, name: str, size: int):
+        self.name = name
+        self.size = size
+        self.in_use = 0
+        self.waiting = 0
+        self.peak = 0
+        self.acquired = 0
+        self.wait_time = 0.0
+
+        self._semaphore = asyncio.Semaphore(size)
+
+    @contextlib.asynccontextmanager
+    async def hold(self) -> AsyncIterator[None]:
+        start = time.monotonic()
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+
+        self.wait_time += time.monotonic() - start
+        self.acquired += 1
+        self.in_use += 1
+        self.peak = max(self.peak, self.in_use)
+        try:
+            yield
+        finally:
+            self.in_use -= 1
+            self._semaphore.release()
+
+    @property
+    def idle(self) -> bool:
+        return self.in_use == 0 and self.waiting == 0
+
+    def stats(self) -> LimitStats:
+        return LimitStats(self.name, self.size, self.in_use, self.waiting, self.peak, self.acquired, self.wait_time)
+
+
+class Reservation:
+    def __init__(self, budget: "ByteBudget", size: int):
+        self.budget = budget
+        self.size = size
+
+    # Bytes beyond the estimate are accounted for without waiting, the transfer is already running.
+    def grow(self, size: int) -> None:
+        self.size += size
+        self.budget.in_use += size
+        self.budget.peak = max(self.budget.peak, self.budget.in_use)
+
+
+# A semaphore counting bytes instead of slots. Reservations are admitted in order, one larger than the whole budget
+# waits until it is admitted alone.
+class ByteBudget:
+    def __init__(self, name: str, size: int):
+        self.name = name
+        self.size = size
+        self.in_use = 0
+        self.peak = 0
+        self.acquired = 0
+        self.wait_time = 0.0
+
+        self._waiters: deque[tuple[int, asyncio.Future[None]]] = deque()
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    def _wake(self) -> None:
+        while self._waiters and self.in_use + self._waiters[0][0] <= self.size:
+            size, waiter = self._waiters.popleft()
+            if not waiter.cancelled():
+                waiter.set_result(None)
+                self.in_use += size
+
+    async def _acquire(self, size: int) -> None:
+        if not self._waiters and self.in_use + size <= self.size:
+            self.in_use += size
+            return
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append((size, waiter))
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.cancelled():
+                with contextlib.suppress(ValueError):
+                    self._waiters.remove((size, waiter))
+            else:
+                self.in_use -= size
+            self._wake()
+            raise
+
+    @contextlib.asynccontextmanager
+    async def reserve(self, size: int) -> AsyncIterator[Reservation]:
+        size = min(size, self.size)
+        start = time.monotonic()
+        await self._acquire(size)
+
+        self.wait_time += time.monotonic() - start
+        self.acquired += 1
+        self.peak = max(self.peak, self.in_use)
+        reservation = Reservation(self, size)
+        try:
+            yield reservation
+        finally:
+            self.in_use -= reservation.size
+            self._wake()
+
+    def stats(self) -> LimitStats:
+        return LimitStats(self.name, self.size, self.in_use, self.waiting, self.peak, self.acquired, self.wait_time)
+
+
+class Scheduler:
+    def __init__(self, total: int, per_user: int, per_host: int, smtp: int):
+        self.per_user = per_user
+        self.per_host = per_host
+        self.total = Limit("total", total)
+        self.smtp = Limit("smtp", smtp)
+
+        self._users: dict[str, Limit] = {}
+        self._hosts: dict[str, Limit] = {}
+
+    def _limit(self, limits: dict[str, Limit], prefix: str, key: str, size: int) -> Limit:
+        if key not in limits:
+            limits[key] = Limit(f"{prefix}:{key}", size)
+        return limits[key]
+
+    @contextlib.asynccontextmanager
+    async def slot(self, user: str, host: str) -> AsyncIterator[None]:
+        # Always acquired in the same order, from the narrowest to the widest limit.
+        user_limit = self._limit(self._users, "user", user, self.per_user)
+        host_limit = self._limit(self._hosts, "host", host, self.per_host)
+        try:
+            async with user_limit.hold(), host_limit.hold(), self.total.hold():
+                yield
+        finally:
+            if user_limit.idle:
+                self._users.pop(user, None)
+
+    def stats(self) -> list[LimitStats]:
+        busiest_user = max(self._users.values(), key=lambda limit: limit.in_use + limit.waiting, default=None)
+        limits = [self.total, self.smtp, *self._hosts.values()]
+        if busiest_user is not None:
+            limits.append(busiest_user)
+        return [limit.stats() for limit in limits]
+
+
+# Deficit round robin over the users of one lane, every user gets the same share of the lane whatever the number of
+# items it queued. An item costs its number of jobs.
+class _Lane(Generic[T]):
+    def __init__(self) -> None:
+        self.queues: dict[str, deque[tuple[T, int]]] = {}
+        self.deficits: dict[str, int] = {}
+        self.active: deque[str] = deque()
+
+    def __bool__(self) -> bool:
+        return bool(self.active)
+
+    def put(self, user: str, item: T, cost: int) -> None:
+        if user not in self.queues:
+            self.queues[user] = deque()
+            self.deficits[user] = 0
+            self.active.append(user)
+        self.queues[user].append((item, cost))
+
+    def pop(self) -> T:
+        while True:
+            user = self.active[0]
+            queue = self.queues[user]
+            item, cost = queue[0]
+            if self.deficits[user] >= cost:
+                self.deficits[user] -= cost
+                queue.popleft()
+                if not queue:
+                    self.active.popleft()
+                    del self.queues[user], self.deficits[user]
+                return item
+
+            self.deficits[user] += 1
+            self.active.rotate(-1)
+
+    def depths(self) -> dict[str, int]:
+        return {user: sum(cost for _, cost in queue) for user, queue in self.queues.items()}
+
+
+# A queue shared fairly by the users, with a fast lane for small batches of fresh articles which is served weight
+# times as often as the bulk lane holding backfills.
+class FairQueue(Generic[T]):
+    def __init__(self, weight: int):
+        self.weight = weight
+        self.fast: _Lane[T] = _Lane()
+        self.bulk: _Lane[T] = _Lane()
+
+        self._fast_served = 0
+        self._items = asyncio.Semaphore(0)
+        self._unfinished = 0
+        self._finished = asyncio.Event()
+        self._finished.set()
+
+    async def put(self, user: str, item: T, cost: int = 1, fast: bool = False) -> None:
+        (self.fast if fast else self.bulk).put(user, item, cost)
+        self._unfinished += 1
+        self._finished.clear()
+        self._items.release()
+
+    async def get(self) -> T:
+        await self._items.acquire()
+        if self.fast and (not self.bulk or self._fast_served < self.weight):
+            self._fast_served += 1
+            return self.fast.pop()
+
+        self._fast_served = 0
+        return self.bulk.pop()
+
+    def task_done(self) -> None:
+        self._unfinished -= 1
+        if self._unfinished == 0:
+            self._finished.set()
+
+    async def join(self) -> None:
+        await self._finished.wait()
+
+    def qsize(self) -> int:
+        return sum(len(queue) for lane in (self.fast, self.bulk) for queue in lane.queues.values())
+
+    def depths(self) -> dict[str, int]:
+        depths = self.bulk.depths()
+        for user, depth in self.fast.depths().items():
+            depths[user] = depths.get(user, 0) + depth
+        return depths
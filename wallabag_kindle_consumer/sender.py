@@ -1,14 +1,17 @@
 import asyncio
-import smtplib
-from email.encoders import encode_base64
-from email.mime.application import MIMEApplication
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.utils import formatdate, make_msgid
+import contextlib
+import multiprocessing
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import IO
 
 from wallabag_kindle_consumer.config import Configuration
 from wallabag_kindle_consumer.logger import logger
+from wallabag_kindle_consumer.message import Message, RenderedMessage, render
 from wallabag_kindle_consumer.models import Job, User
+from wallabag_kindle_consumer.scheduler import ByteBudget
+from wallabag_kindle_consumer.smtp import SMTPPool
 
 
 class Sender:
@@ -21,6 +24,11 @@ class Sender:
         smtp_user: str = "",
         smtp_passwd: str = "",
         smtp_tls: bool = True,
+        pool_size: int = 4,
+        idle_timeout: float = 60,
+        timeout: float = 60,
+        encode_workers: int = 0,
+        budget: ByteBudget | None = None,
     ):
         self.from_addr = from_addr
         self.loop = loop
@@ -29,70 +37,106 @@ class Sender:
         self.user = smtp_user
         self.passwd = smtp_passwd
         self.encryption_enabled = smtp_tls
+        self.budget = budget
+        self.pool = SMTPPool(
+            host=smtp_server,
+            port=smtp_port,
+            user=smtp_user,
+            passwd=smtp_passwd,
+            starttls=smtp_tls,
+            size=pool_size,
+            idle_timeout=idle_timeout,
+            timeout=timeout,
+        )
+        # Encoding large attachments takes the GIL from the event loop, worker processes use the other cores.
+        self.encoder: ProcessPoolExecutor | None = None
+        if encode_workers > 0:
+            self.encoder = ProcessPoolExecutor(encode_workers, mp_context=multiprocessing.get_context("spawn"))
 
-    def _send_mail(self, title: str, article: str, format: str, email: str, data: bytes) -> None:
-        msg = MIMEMultipart()
-        msg["Subject"] = f"Send article '{title}'"
-        msg["From"] = self.from_addr
-        msg["To"] = email
-        msg["Date"] = formatdate(localtime=True)
-        msg["Message-ID"] = make_msgid("wallabag-kindle")
+    async def _render(self, subject: str, email: str, text: str, attachments: list[tuple[str, str]]) -> IO[bytes]:
+        fd, path = tempfile.mkstemp(suffix=".eml")
+        os.close(fd)
+        try:
+            await self.loop.run_in_executor(
+                self.encoder, render, self.from_addr, email, subject, text, attachments, path
+            )
+            # Still readable after being unlinked, the file is gone once it is closed.
+            return open(path, "rb")
+        finally:
+            os.unlink(path)
 
+    async def _send(self, subject: str, email: str, attachments: list[tuple[str, IO[bytes]]]) -> bool:
         text = "This email has been automatically sent."
-        msg.attach(MIMEText(text))
-
-        mobi = MIMEApplication(data)
-        encode_base64(mobi)
-        mobi.add_header("Content-Disposition", "attachment", filename=f"{title}.{format}")
-
-        msg.attach(mobi)
-
-        smtp = smtplib.SMTP(host=self.host, port=self.port)
-        if self.encryption_enabled:
-            smtp.starttls()
-        if self.user:
-            smtp.login(self.user, self.passwd)
+        # Attachments are handed to the workers by path, exports which aren't stored in a file are encoded here.
+        paths = [
+            (filename, data.name) for filename, data in attachments if isinstance(getattr(data, "name", None), str)
+        ]
+        # Base64 grows the attachments by a third, plus the line breaks.
+        size = sum(data.seek(0, os.SEEK_END) for _, data in attachments) * 78 // 57
         try:
-            smtp.sendmail(self.from_addr, [email], msg.as_string())
-            smtp.quit()
-            logger.info(f"Mail with article {article} in format {format} with title '{title}' sent to {email}")
+            async with self.budget.reserve(size) if self.budget else contextlib.nullcontext():
+                if (
+                    self.encoder is not None
+                    and len(paths) == len(attachments)
+                    and all(os.path.isfile(path) for _, path in paths)
+                ):
+                    with await self._render(subject, email, text, paths) as rendered:
+                        await self.pool.sendmail(self.from_addr, [email], RenderedMessage(rendered))
+                else:
+                    msg = Message(self.from_addr, email, subject, text)
+                    for filename, data in attachments:
+                        msg.attach(filename, data)
+                    await self.pool.sendmail(self.from_addr, [email], msg)
         except Exception:
             logger.exception("Error sending mail")
+            return False
 
-    async def send_mail(self, job: Job, data: bytes) -> asyncio.Future[None]:
-        return self.loop.run_in_executor(
-            None, self._send_mail, job.title, job.article, job.format, job.user.kindle_mail, data
-        )
+        return True
 
-    def _send_warning(self, email: str, config: Configuration) -> None:
-        msg = MIMEMultipart()
-        msg["Subject"] = "Wallabag-Kindle-Consumer Notice"
-        msg["From"] = self.from_addr
-        msg["To"] = email
-        msg["Date"] = formatdate(localtime=True)
+    async def send_mail(self, job: Job, data: IO[bytes]) -> bool:
+        title, article, format, email = job.title, job.article, job.format, job.user.kindle_mail
+        if not await self._send(f"Send article '{title}'", email, [(f"{title}.{format}", data)]):
+            return False
 
-        txt = MIMEText(
+        logger.info(f"Mail with article {article} in format {format} with title '{title}' sent to {email}")
+        return True
+
+    async def send_mails(self, jobs: list[tuple[Job, IO[bytes]]]) -> bool:
+        if len(jobs) == 1:
+            return await self.send_mail(*jobs[0])
+
+        email = jobs[0][0].user.kindle_mail
+        attachments = [(f"{job.title}.{job.format}", data) for job, data in jobs]
+        if not await self._send(f"Send {len(jobs)} articles", email, attachments):
+            return False
+
+        articles = ", ".join(f"{job.article} ({job.format})" for job, _ in jobs)
+        logger.info(f"Mail with articles {articles} sent to {email}")
+        return True
+
+    async def send_warning(self, user: User, config: Configuration) -> bool:
+        msg = Message(
+            self.from_addr,
+            user.email,
+            "Wallabag-Kindle-Consumer Notice",
             (
                 "the Wallabag-Kindle-Consumer for your Wallabag "
                 "account on {wallabag} was not able to refresh "
                 "the access token. Please go to {url}/update and log "
                 "in again to retrieve a new api token."
-            ).format(wallabag=config.wallabag_host, url=config.domain)
+            ).format(wallabag=config.wallabag_host, url=config.domain),
         )
 
-        msg.attach(txt)
-
-        smtp = smtplib.SMTP(host=self.host, port=self.port)
-        if self.encryption_enabled:
-            smtp.starttls()
-        if self.user:
-            smtp.login(self.user, self.passwd)
         try:
-            smtp.sendmail(self.from_addr, [email], msg.as_string())
-            smtp.quit()
-            logger.info(f"Notify email sent to {email}")
+            await self.pool.sendmail(self.from_addr, [user.email], msg)
         except Exception:
             logger.exception("Error sending notify mail")
+            return False
+
+        logger.info(f"Notify email sent to {user.email}")
+        return True
 
-    async def send_warning(self, user: User, config: Configuration) -> asyncio.Future[None]:
-        return self.loop.run_in_executor(None, self._send_warning, user.email, config)
+    async def close(self) -> None:
+        await self.pool.close()
+        if self.encoder is not None:
+            self.encoder.shutdown(cancel_futures=True)
@@ -0,0 +1,262 @@
+import asyncio
+import base64
+import contextlib
+import smtplib
+import ssl
+import time
+from collections import deque
+from collections.abc import AsyncIterator, Iterable
+
+from wallabag_kindle_consumer import metrics
+from wallabag_kindle_consumer.logger import logger
+
+# Reused connections idle for longer than this are checked with a NOOP first.
+NOOP_AFTER = 5.0
+
+
+class SMTPConnection:
+    def __init__(self, host: str, port: int, user: str, passwd: str, starttls: bool, timeout: float):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.passwd = passwd
+        self.starttls = starttls
+        self.timeout = timeout
+        self.last_used = time.monotonic()
+
+        self._reader: asyncio.StreamReader | None = None
+        self._writer: asyncio.StreamWriter | None = None
+        self._extensions: dict[str, str] = {}
+
+    @property
+    def reader(self) -> asyncio.StreamReader:
+        if self._reader is None:
+            raise smtplib.SMTPServerDisconnected("Not connected")
+        return self._reader
+
+    @property
+    def writer(self) -> asyncio.StreamWriter:
+        if self._writer is None:
+            raise smtplib.SMTPServerDisconnected("Not connected")
+        return self._writer
+
+    async def connect(self) -> None:
+        started = time.monotonic()
+        try:
+            await self._connect()
+        except BaseException:
+            metrics.SMTP_CONNECT.observe(time.monotonic() - started, "error")
+            raise
+        metrics.SMTP_CONNECT.observe(time.monotonic() - started, "ok")
+
+    async def _connect(self) -> None:
+        self._reader, self._writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+        await self._expect(220)
+        await self._ehlo()
+
+        if self.starttls:
+            await self.command("STARTTLS", 220)
+            await asyncio.wait_for(
+                self.writer.start_tls(ssl.create_default_context(), server_hostname=self.host), self.timeout
+            )
+            await self._ehlo()
+
+        if self.user:
+            await self._login()
+
+        self.last_used = time.monotonic()
+
+    async def _reply(self) -> tuple[int, str]:
+        lines = []
+        while True:
+            line = await asyncio.wait_for(self.reader.readline(), self.timeout)
+            if not line:
+                raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+            lines.append(line[4:].strip().decode(errors="replace"))
+            if line[3:4] != b"-":
+                return int(line[:3]), "\n".join(lines)
+
+    async def _expect(self, *codes: int) -> tuple[int, str]:
+        code, msg = await self._reply()
+        if code not in codes:
+            raise smtplib.SMTPResponseException(code, msg)
+        return code, msg
+
+    async def command(self, line: str, *codes: int) -> tuple[int, str]:
+        self.writer.write(f"{line}\r\n".encode())
+        await self.writer.drain()
+        return await self._expect(*codes)
+
+    async def _ehlo(self) -> None:
+        _, msg = await self.command("EHLO wallabag-kindle-consumer", 250)
+        self._extensions = {}
+        for line in msg.splitlines()[1:]:
+            name, _, params = line.partition(" ")
+            self._extensions[name.upper()] = params
+
+    async def _login(self) -> None:
+        mechanisms = self._extensions.get("AUTH", "").upper().split()
+        if "PLAIN" in mechanisms or "LOGIN" not in mechanisms:
+            token = base64.b64encode(f"\0{self.user}\0{self.passwd}".encode()).decode()
+            await self.command(f"AUTH PLAIN {token}", 235)
+        else:
+            await self.command("AUTH LOGIN", 334)
+            await self.command(base64.b64encode(self.user.encode()).decode(), 334)
+            await self.command(base64.b64encode(self.passwd.encode()).decode(), 235)
+
+    async def _check(self, line: str) -> bool:
+        try:
+            await self.command(line, 250)
+        except (smtplib.SMTPException, OSError, asyncio.TimeoutError):
+            return False
+        return True
+
+    async def noop(self) -> bool:
+        return await self._check("NOOP")
+
+    async def reset(self) -> bool:
+        return await self._check("RSET")
+
+    async def sendmail(self, from_addr: str, to_addrs: list[str], msg: Iterable[bytes]) -> None:
+        started = time.monotonic()
+        try:
+            await self._sendmail(from_addr, to_addrs, msg)
+        except BaseException:
+            metrics.SMTP_SEND.observe(time.monotonic() - started, "error")
+            raise
+        metrics.SMTP_SEND.observe(time.monotonic() - started, "ok")
+
+    async def _sendmail(self, from_addr: str, to_addrs: list[str], msg: Iterable[bytes]) -> None:
+        await self.command(f"MAIL FROM:<{from_addr}>", 250)
+        for addr in to_addrs:
+            await self.command(f"RCPT TO:<{addr}>", 250, 251)
+        await self.command("DATA", 354)
+
+        try:
+            # Dot-stuff lines starting with a dot, including those split between two chunks.
+            tail = b"\r\n"
+            for chunk in msg:
+                if not chunk:
+                    continue
+                data = (tail + chunk).replace(b"\r\n.", b"\r\n..")[len(tail) :]
+                tail = (tail + chunk)[-2:]
+                self.writer.write(data)
+                await self.writer.drain()
+
+            self.writer.write(b".\r\n" if tail == b"\r\n" else b"\r\n.\r\n")
+            await self.writer.drain()
+        except BaseException:
+            # Anything sent now would become part of the message, the transaction can only be dropped.
+            self.abort()
+            raise
+        await self._expect(250)
+        self.last_used = time.monotonic()
+
+    def abort(self) -> None:
+        if self._writer is None:
+            return
+
+        self._writer.transport.abort()
+        self._reader = self._writer = None
+
+    async def close(self) -> None:
+        if self._writer is None:
+            return
+
+        with contextlib.suppress(smtplib.SMTPException, OSError, asyncio.TimeoutError):
+            await self.command("QUIT", 221)
+        self._writer.close()
+        with contextlib.suppress(OSError, ssl.SSLError):
+            await self._writer.wait_closed()
+        self._reader = self._writer = None
+
+
+class SMTPPool:
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        user: str = "",
+        passwd: str = "",
+        starttls: bool = True,
+        size: int = 4,
+        idle_timeout: float = 60,
+        timeout: float = 60,
+    ):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.passwd = passwd
+        self.starttls = starttls
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+
+        self._idle: deque[SMTPConnection] = deque()
+        self._slots = asyncio.Semaphore(size)
+
+    async def _acquire(self) -> SMTPConnection:
+        while self._idle:
+            conn = self._idle.pop()
+            idle = time.monotonic() - conn.last_used
+            if idle > self.idle_timeout:
+                await conn.close()
+            elif idle < NOOP_AFTER or await conn.noop():
+                return conn
+            else:
+                await conn.close()
+
+        conn = SMTPConnection(self.host, self.port, self.user, self.passwd, self.starttls, self.timeout)
+        await conn.connect()
+        logger.debug(f"Opened SMTP connection to {self.host}:{self.port}")
+        return conn
+
+    async def _release(self, conn: SMTPConnection) -> None:
+        self._idle.append(conn)
+        now = time.monotonic()
+        while self._idle and now - self._idle[0].last_used > self.idle_timeout:
+            await self._idle.popleft().close()
+
+    @contextlib.asynccontextmanager
+    async def connection(self) -> AsyncIterator[SMTPConnection]:
+        async with self._slots:
+            conn = await self._acquire()
+            try:
+                yield conn
+            except smtplib.SMTPResponseException as e:
+                # Abort the mail transaction to keep the connection usable.
+                if e.smtp_code == 421 or not await conn.reset():
+                    await conn.close()
+                else:
+                    await self._release(conn)
+                raise
+            except BaseException:
+                await conn.close()
+                raise
+            await self._release(conn)
+
+    async def sendmail(self, from_addr: str, to_addrs: list[str], msg: Iterable[bytes]) -> None:
+        try:
+            async with self.connection() as conn:
+                await conn.sendmail(from_addr, to_addrs, msg)
+                return
+        except smtplib.SMTPResponseException as e:
+            # 421 and other 4xx replies are transient, try once more on a fresh connection.
+            if not 400 <= e.smtp_code < 500:
+                raise
+            logger.warning(f"SMTP server answered {e.smtp_code} {e.smtp_error!r}, retry")
+        except (smtplib.SMTPServerDisconnected, ConnectionError):
+            logger.warning("SMTP connection lost, retry")
+
+        async with self._slots:
+            conn = SMTPConnection(self.host, self.port, self.user, self.passwd, self.starttls, self.timeout)
+            try:
+                await conn.connect()
+                await conn.sendmail(from_addr, to_addrs, msg)
+            except BaseException:
+                await conn.close()
+                raise
+            await self._release(conn)
+
+    async def close(self) -> None:
+        while self._idle:
+            await self._idle.pop().close()
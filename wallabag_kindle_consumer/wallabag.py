@@ -1,31 +1,66 @@
+import asyncio
+import calendar
+import contextlib
+import dataclasses
+import re
+import tempfile
+import time
 from collections import namedtuple
-from collections.abc import AsyncIterator
+from collections.abc import AsyncIterator, Callable
 from datetime import datetime, timedelta
+from types import SimpleNamespace
+from typing import IO, Any
 
 import aiohttp
+import orjson
+from sqlalchemy import select
 
+from wallabag_kindle_consumer import metrics
+from wallabag_kindle_consumer.cache import ExportCache
 from wallabag_kindle_consumer.config import Configuration
 from wallabag_kindle_consumer.logger import logger
-from wallabag_kindle_consumer.models import User
+from wallabag_kindle_consumer.models import User, session_maker
+from wallabag_kindle_consumer.scheduler import ByteBudget
 
 
 class Article:
-    def __init__(self, id, tags, title, tag, **kwargs):
+    __slots__ = ("id", "title", "url", "updated_at", "tag", "duplicates", "tag_ids")
+
+    def __init__(self, id, tags, title, tag, url=None, updated_at=None, **kwargs):
         self.id = id
-        self.tags = tags
         self.title = title
+        self.url = url
+        self.updated_at = updated_at
         self.tag = tag
+        self.duplicates = []
+        self.tag_ids = {t["label"]: t["id"] for t in tags}
+
+    @classmethod
+    def from_entry(cls, entry, tag):
+        return cls(
+            id=entry["id"],
+            tags=entry["tags"],
+            title=entry["title"],
+            tag=tag,
+            url=entry.get("url"),
+            updated_at=entry.get("updated_at"),
+        )
 
-    def tag_id(self) -> int:
-        for t in self.tags:
-            if t["label"] == self.tag.tag:
-                return t["id"]
+    def tag_id(self, tag=None) -> int:
+        return self.tag_ids.get((tag or self.tag).tag, -1)
 
-        return -1
+    def all_tags(self):
+        return (self.tag, *self.duplicates)
 
 
 Tag = namedtuple("Tag", ["tag", "format"])
 
+EXPORT_CHUNK_SIZE = 64 * 1024
+# Entry and tag ids in request paths, replaced to keep the number of endpoints in the metrics small.
+ID_PATTERN = re.compile(r"/\d+(?=[/.]|$)")
+# Reserved for an export without a Content-Length until one of its format was seen.
+EXPORT_SIZE_ESTIMATE = 1024 * 1024
+
 
 def make_tags(tag: str, default_format: str) -> tuple[Tag, ...]:
     return (
@@ -36,11 +71,121 @@ def make_tags(tag: str, default_format: str) -> tuple[Tag, ...]:
     )
 
 
+@dataclasses.dataclass
+class ConnectionStats:
+    requests: int = 0
+    connections_opened: int = 0
+    connections_reused: int = 0
+    # Tags asked to be removed and the requests it took, one request per tag without the bulk endpoint.
+    tags_removed: int = 0
+    tag_requests: int = 0
+
+    @property
+    def tag_requests_saved(self) -> int:
+        return self.tags_removed - self.tag_requests
+
+
 class Wallabag:
-    def __init__(self, config: Configuration):
+    def __init__(self, config: Configuration, budget: ByteBudget | None = None):
         self.config = config
+        self.budget = budget
         self.tag = config.tag
         self.tags = make_tags(tag=self.tag, default_format=config.default_format)
+        self.stats = ConnectionStats()
+        self.cache: ExportCache | None = None
+        if config.export_cache_dir:
+            self.cache = ExportCache(config.export_cache_dir, config.export_cache_size * 1024 * 1024)
+
+        # Tags listed first win when an article is found under several tags of the same format.
+        self._tag_priority = {tag: i for i, tag in enumerate(self.tags)}
+        # ETag / Last-Modified of the last empty listing per (user, tag) and the query they belong to, without since.
+        self._validators: dict[tuple[str, str], tuple[dict[str, str], dict[str, str]]] = {}
+        # Cleared as soon as an older server rejects the detail parameter.
+        self._metadata_listing = True
+        # A moving average of the export sizes per format, to estimate exports without a Content-Length.
+        self._export_sizes: dict[str, int] = {}
+        # Cleared as soon as an older server lacks the bulk tag removal endpoint.
+        self._bulk_tags = config.tag_batch_size > 0
+
+        self._session: aiohttp.ClientSession | None = None
+        self.sessionmaker = session_maker(config)
+        # Token refreshes in progress per user, concurrent callers wait for the same one.
+        self._refreshing: dict[str, asyncio.Future[tuple[str, str, datetime] | None]] = {}
+
+    async def open(self) -> None:
+        if self._session is not None:
+            return
+
+        connector = aiohttp.TCPConnector(
+            limit=self.config.http_pool_size,
+            limit_per_host=self.config.http_pool_per_host,
+            keepalive_timeout=self.config.http_keepalive,
+            ttl_dns_cache=self.config.http_dns_ttl,
+            use_dns_cache=True,
+        )
+        timeout = aiohttp.ClientTimeout(
+            total=self.config.http_timeout,
+            sock_connect=self.config.http_connect_timeout,
+        )
+        self._session = aiohttp.ClientSession(
+            connector=connector, timeout=timeout, trace_configs=[self._trace_config()]
+        )
+
+    async def close(self) -> None:
+        if self._session is None:
+            return
+
+        await self._session.close()
+        self._session = None
+        logger.info(
+            f"Closed wallabag session after {self.stats.requests} requests "
+            f"on {self.stats.connections_opened} connections"
+        )
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None:
+            raise RuntimeError("Wallabag session is not open")
+        return self._session
+
+    def _trace_config(self) -> aiohttp.TraceConfig:
+        async def on_request_start(
+            session: aiohttp.ClientSession, ctx: SimpleNamespace, params: aiohttp.TraceRequestStartParams
+        ) -> None:
+            self.stats.requests += 1
+            ctx.started = time.monotonic()
+
+        async def on_request_end(
+            session: aiohttp.ClientSession, ctx: SimpleNamespace, params: aiohttp.TraceRequestEndParams
+        ) -> None:
+            endpoint = ID_PATTERN.sub("/{id}", params.url.path)
+            metrics.WALLABAG_REQUESTS.observe(
+                time.monotonic() - ctx.started, params.method, endpoint, str(params.response.status)
+            )
+
+        async def on_request_exception(
+            session: aiohttp.ClientSession, ctx: SimpleNamespace, params: aiohttp.TraceRequestExceptionParams
+        ) -> None:
+            endpoint = ID_PATTERN.sub("/{id}", params.url.path)
+            metrics.WALLABAG_REQUESTS.observe(time.monotonic() - ctx.started, params.method, endpoint, "error")
+
+        async def on_connection_create_end(
+            session: aiohttp.ClientSession, ctx: SimpleNamespace, params: aiohttp.TraceConnectionCreateEndParams
+        ) -> None:
+            self.stats.connections_opened += 1
+
+        async def on_connection_reuseconn(
+            session: aiohttp.ClientSession, ctx: SimpleNamespace, params: aiohttp.TraceConnectionReuseconnParams
+        ) -> None:
+            self.stats.connections_reused += 1
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_request_end.append(on_request_end)
+        trace_config.on_request_exception.append(on_request_exception)
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+        return trace_config
 
     async def get_token(self, user: User, passwd: str) -> bool:
         params = {
@@ -51,18 +196,17 @@ class Wallabag:
             "password": passwd,
         }
 
-        async with aiohttp.ClientSession() as session:
-            async with session.post(self._url("/oauth/v2/token"), json=params) as resp:
-                if resp.status != 200:
-                    logger.error(f"Cannot get token for user {user.name}", exc_info=True)
-                    return False
-                data = await resp.json()
-                user.auth_token = data["access_token"]
-                user.refresh_token = data["refresh_token"]
-                user.token_valid = datetime.utcnow() + timedelta(seconds=data["expires_in"])
-                logger.info(f"Got new token for {user.name}")
+        async with self.session.post(self._url("/oauth/v2/token"), json=params) as resp:
+            if resp.status != 200:
+                logger.error(f"Cannot get token for user {user.name}", exc_info=True)
+                return False
+            data = await resp.json()
+            user.auth_token = data["access_token"]
+            user.refresh_token = data["refresh_token"]
+            user.token_valid = datetime.utcnow() + timedelta(seconds=data["expires_in"])
+            logger.info(f"Got new token for {user.name}")
 
-                return True
+            return True
 
     async def refresh_token(self, user: User) -> bool:
         params = {
@@ -73,17 +217,68 @@ class Wallabag:
             "username": user.name,
         }
 
-        async with aiohttp.ClientSession() as session:
-            async with session.post(self._url("/oauth/v2/token"), json=params) as resp:
-                if resp.status != 200:
-                    logger.error(f"Cannot refresh token for user {user.name}", exc_info=True)
-                    return False
-                data = await resp.json()
-                user.auth_token = data["access_token"]
-                user.refresh_token = data["refresh_token"]
-                user.token_valid = datetime.utcnow() + timedelta(seconds=data["expires_in"])
+        async with self.session.post(self._url("/oauth/v2/token"), json=params) as resp:
+            if resp.status != 200:
+                logger.error(f"Cannot refresh token for user {user.name}", exc_info=True)
+                return False
+            data = await resp.json()
+            user.auth_token = data["access_token"]
+            user.refresh_token = data["refresh_token"]
+            user.token_valid = datetime.utcnow() + timedelta(seconds=data["expires_in"])
+
+            return True
+
+    async def _refresh_stored(self, name: str, rejected_token: str) -> tuple[str, str, datetime] | None:
+        async with self.sessionmaker() as session:
+            # The row lock keeps other replicas from using the same refresh token, which is only valid once.
+            user = await session.scalar(select(User).where(User.name == name).with_for_update())
+            if user is None or not user.active:
+                return None
+
+            if user.auth_token == rejected_token or user.token_valid <= datetime.utcnow():
+                if not await self.refresh_token(user):
+                    metrics.REFRESHES.inc("failed")
+                    return None
+                await session.commit()
+                metrics.REFRESHES.inc("refreshed")
+            else:
+                logger.debug(f"Token of user {name} was refreshed meanwhile, use it")
+                metrics.REFRESHES.inc("reused")
+
+            return user.auth_token, user.refresh_token, user.token_valid
+
+    async def refresh_shared(self, user: User) -> bool:
+        if user.name not in self._refreshing:
+            refreshing = asyncio.ensure_future(self._refresh_stored(user.name, user.auth_token))
+            refreshing.add_done_callback(lambda _: self._refreshing.pop(user.name, None))
+            self._refreshing[user.name] = refreshing
+
+        # Shielded, a cancelled caller doesn't abort the refresh the others wait for.
+        tokens = await asyncio.shield(self._refreshing[user.name])
+        if tokens is None:
+            return False
+
+        user.auth_token, user.refresh_token, user.token_valid = tokens
+        return True
 
-                return True
+    @contextlib.asynccontextmanager
+    async def _request(
+        self, method: str, user: User, url: str, params: dict[str, str] | None = None, **kwargs: Any
+    ) -> AsyncIterator[aiohttp.ClientResponse]:
+        token = user.auth_token
+        resp = await self.session.request(method, url, params=self._api_params(user, dict(params or {})), **kwargs)
+        try:
+            # A token expired early or was revoked, refresh it once and retry.
+            if resp.status == 401:
+                resp.release()
+                logger.info(f"Token of user {user.name} was rejected, refresh it")
+                if user.auth_token != token or await self.refresh_shared(user):
+                    resp = await self.session.request(
+                        method, url, params=self._api_params(user, dict(params or {})), **kwargs
+                    )
+            yield resp
+        finally:
+            resp.release()
 
     def _api_params(self, user: User, params: dict[str, str] | None = None) -> dict[str, str]:
         if params is None:
@@ -95,52 +290,300 @@ class Wallabag:
     def _url(self, url: str) -> str:
         return self.config.wallabag_host + url
 
-    async def fetch_entries(self, user: User) -> AsyncIterator[Article]:
+    @staticmethod
+    def _validator_query(query: dict[str, str]) -> dict[str, str]:
+        # since moves with every poll. An unchanged tag has no entries updated since any time, so the validators
+        # hold across it.
+        return {k: v for k, v in query.items() if k != "since"}
+
+    def _conditional_headers(self, user: User, tag: Tag, query: dict[str, str]) -> dict[str, str]:
+        # The periodic full listings always get the entries, they pick up whatever an incremental one missed.
+        if "since" not in query:
+            return {}
+
+        known = self._validators.get((user.name, tag.tag))
+        if known is None or known[0] != self._validator_query(query):
+            return {}
+
+        return known[1]
+
+    def _store_validators(
+        self, user: User, tag: Tag, query: dict[str, str], resp: aiohttp.ClientResponse, data: dict[str, Any]
+    ) -> None:
+        # Only an empty listing is safe to skip next time. Listed entries stay tagged until their jobs are stored and
+        # the tags removed, which may still fail, so their listing must not turn into a 304.
+        if data["_embedded"]["items"]:
+            self._validators.pop((user.name, tag.tag), None)
+            return
+
+        headers = {}
+        if "ETag" in resp.headers:
+            headers["If-None-Match"] = resp.headers["ETag"]
+        if "Last-Modified" in resp.headers:
+            headers["If-Modified-Since"] = resp.headers["Last-Modified"]
+
+        if headers:
+            self._validators[(user.name, tag.tag)] = (self._validator_query(query), headers)
+
+    async def _fetch_page(self, user: User, tag: Tag, page: int, query: dict[str, str]) -> dict[str, Any] | None:
+        # Listings in progress request their next pages in full too once the server rejected the detail parameter.
+        if not self._metadata_listing:
+            query = {k: v for k, v in query.items() if k != "detail"}
+        params = {**query, "tags": tag.tag, "page": str(page)}
+        headers = self._conditional_headers(user, tag, query) if page == 1 else {}
+
+        async with self._request("GET", user, self._url("/api/entries.json"), params, headers=headers) as resp:
+            if resp.status == 304:
+                logger.debug(f"Entries of tag {tag.tag} for user {user.name} not modified")
+                return {"page": 1, "pages": 1, "_embedded": {"items": []}}
+
+            if resp.status == 200:
+                data = orjson.loads(await resp.read())
+                if page == 1:
+                    self._store_validators(user, tag, query, resp, data)
+
+                return data
+
+        if resp.status == 400 and "detail" in query:
+            if self._metadata_listing:
+                logger.info("Wallabag does not support metadata only listings, request full entries")
+                self._metadata_listing = False
+            return await self._fetch_page(user, tag, page, query)
+
+        logger.warning(f"Could not get page {page} of tag {tag.tag} for user {user.name}")
+        return None
+
+    async def _prefetch_pages(
+        self, user: User, tag: Tag, query: dict[str, str], queue: asyncio.Queue[dict[str, Any] | None]
+    ) -> None:
+        page = 1
+        cancelled = False
+        try:
+            while True:
+                data = await self._fetch_page(user, tag, page, query)
+                if data is None:
+                    break
+
+                await queue.put(data)
+                if page >= data["pages"]:
+                    return
+                page += 1
+        except (aiohttp.ClientError, asyncio.TimeoutError, KeyError, ValueError):
+            logger.exception(f"Failed to fetch page {page} of tag {tag.tag} for user {user.name}")
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        finally:
+            # Also unexpected errors end the pages, _tag_pages raises them once it gets the sentinel.
+            if not cancelled:
+                await queue.put(None)
+
+    async def _tag_pages(self, user: User, tag: Tag, query: dict[str, str]) -> AsyncIterator[dict[str, Any] | None]:
+        queue: asyncio.Queue[dict[str, Any] | None] = asyncio.Queue(maxsize=self.config.fetch_lookahead)
+        fetcher = asyncio.ensure_future(self._prefetch_pages(user, tag, query, queue))
+
+        try:
+            while True:
+                data = await queue.get()
+                if data is None:
+                    await fetcher
+                yield data
+
+                if data is None or data["page"] >= data["pages"]:
+                    return
+        finally:
+            fetcher.cancel()
+
+    async def _list_tag(
+        self, user: User, tag: Tag, query: dict[str, str], queue: asyncio.Queue[Article | None]
+    ) -> bool:
+        async for data in self._tag_pages(user, tag, query):
+            if data is None:
+                return False
+
+            for article in data["_embedded"]["items"]:
+                await queue.put(Article.from_entry(article, tag))
+
+        return True
+
+    async def _list_tags(self, user: User, query: dict[str, str], queue: asyncio.Queue[Article | None]) -> bool:
+        listings = [asyncio.ensure_future(self._list_tag(user, tag, query, queue)) for tag in self.tags]
+        cancelled = False
+        try:
+            return all(await asyncio.gather(*listings))
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        finally:
+            # The other tags stop after an error, which fetch_entries raises once it gets the sentinel.
+            for listing in listings:
+                listing.cancel()
+            if not cancelled:
+                await queue.put(None)
+
+    async def fetch_entries(self, user: User, since: datetime | None = None) -> AsyncIterator[Article]:
         if user.auth_token is None:
             logger.error(f"No auth token for {user.name}", exc_info=True)
             return
-        async with aiohttp.ClientSession() as session:
-            for tag in self.tags:
-                params = self._api_params(user, {"tags": tag.tag})
-                async with session.get(self._url("/api/entries.json"), params=params) as resp:
-                    if resp.status != 200:
-                        logger.warning(f"Could not get entries of tag {tag.tag} for user {user.name}")
-                        return
-
-                    data = await resp.json()
-                    if data["pages"] == 1:
-                        user.last_check = datetime.utcnow()
-
-                    articles = data["_embedded"]["items"]
-                    for article in articles:
-                        yield Article(tag=tag, **article)
-
-    async def remove_tag(self, user: User, article: Article) -> None:
-        params = self._api_params(user)
-        tag = article.tag_id()
-        url = self._url(f"/api/entries/{article.id}/tags/{tag}.json")
-
-        async with aiohttp.ClientSession() as session:
-            async with session.delete(url, params=params) as resp:
-                if resp.status != 200:
-                    logger.warning(
-                        f"Cannot remove tag {article.tag.tag} from entry '{article.title}' of user {user.name}",
-                    )
-                    return
+
+        query = {"perPage": str(self.config.fetch_per_page)}
+        if self._metadata_listing:
+            query["detail"] = "metadata"
+        if since is not None:
+            query["since"] = str(calendar.timegm(since.utctimetuple()))
+
+        started = datetime.utcnow()
+        queue: asyncio.Queue[Article | None] = asyncio.Queue(maxsize=self.config.fetch_per_page)
+        listing = asyncio.ensure_future(self._list_tags(user, query, queue))
+
+        seen: dict[tuple[int, str], Article] = {}
+        try:
+            while (article := await queue.get()) is not None:
+                key = (article.id, article.tag.format)
+                if key not in seen:
+                    seen[key] = article
+                    yield article
+                    continue
+
+                # The article was already yielded, so only record the tag to remove it as well.
+                known = seen[key]
+                if self._tag_priority[article.tag] < self._tag_priority[known.tag]:
+                    known.duplicates.append(known.tag)
+                    known.tag = article.tag
+                else:
+                    known.duplicates.append(article.tag)
+                logger.debug(f"Entry {article.id} tagged with {article.tag.tag} and {known.tag.tag}, send it once")
+
+            if await listing:
+                user.last_check = started
+        finally:
+            listing.cancel()
+
+    async def remove_tags(
+        self, user: User, articles: list[Article], slot: Callable[[], contextlib.AbstractAsyncContextManager[None]]
+    ) -> None:
+        # Only the tags of the listed articles are removed, articles tagged meanwhile are found by the next fetch.
+        # Every request holds a slot of the caller's limits, like the listing and the exports.
+        self.stats.tags_removed += sum(len(article.all_tags()) for article in articles)
+
+        remaining = articles
+        if self._bulk_tags:
+            remaining = []
+            size = self.config.tag_batch_size
+            for start in range(0, len(articles), size):
+                if not self._bulk_tags:
+                    remaining.extend(articles[start:])
+                    break
+                async with slot():
+                    remaining.extend(await self._remove_tags_bulk(user, articles[start : start + size]))
+
+        async def remove(article: Article, tag: Tag) -> None:
+            async with slot():
+                await self._remove_tag(user, article, tag)
+
+        await asyncio.gather(*(remove(article, tag) for article in remaining for tag in article.all_tags()))
+
+    async def _remove_tags_bulk(self, user: User, articles: list[Article]) -> list[Article]:
+        # Wallabag looks the entries up by url, articles without a unique one are untagged one by one.
+        by_url = {article.url: article for article in articles if article.url}
+        remaining = [article for article in articles if by_url.get(article.url) is not article]
+        if not by_url:
+            return remaining
+
+        items = [
+            {"url": url, "tags": ",".join(tag.tag for tag in article.all_tags())} for url, article in by_url.items()
+        ]
+        params = {"list": orjson.dumps(items).decode()}
+
+        self.stats.tag_requests += 1
+        async with self._request("DELETE", user, self._url("/api/entries/tags/list.json"), params) as resp:
+            if resp.status in (404, 405):
+                logger.info("Wallabag does not support removing tags in bulk, remove them per entry")
+                self._bulk_tags = False
+                return articles
+
+            if resp.status != 200:
+                logger.warning(f"Cannot remove tags from {len(by_url)} entries of user {user.name}")
+                return articles
+
+            try:
+                results = orjson.loads(await resp.read())
+            except ValueError:
+                logger.warning(f"Invalid response removing tags from {len(by_url)} entries of user {user.name}")
+                return articles
+
+        for result in results:
+            article = by_url.get(result.get("url"))
+            if article is not None and result.get("entry") == article.id:
+                del by_url[article.url]
                 logger.info(
-                    f"Removed tag {article.tag.tag} from article '{article.title}' of user {user.name}",
+                    f"Removed tags {', '.join(tag.tag for tag in article.all_tags())} from article "
+                    f"'{article.title}' of user {user.name}",
+                )
+
+        # Entries the server did not find by url.
+        remaining.extend(by_url.values())
+        return remaining
+
+    async def _remove_tag(self, user: User, article: Article, tag: Tag) -> None:
+        url = self._url(f"/api/entries/{article.id}/tags/{article.tag_id(tag)}.json")
+
+        self.stats.tag_requests += 1
+        async with self._request("DELETE", user, url) as resp:
+            if resp.status != 200:
+                logger.warning(
+                    f"Cannot remove tag {tag.tag} from entry '{article.title}' of user {user.name}",
                 )
+                return
+            logger.info(
+                f"Removed tag {tag.tag} from article '{article.title}' of user {user.name}",
+            )
+
+    # Yields the export, which counts against the byte budget until the caller stored it and left the context.
+    @contextlib.asynccontextmanager
+    async def export_article(
+        self, user: User, article_id: int, format: str, updated_at: str | None = None
+    ) -> AsyncIterator[IO[bytes] | None]:
+        key = None
+        if self.cache is not None and updated_at is not None:
+            key = self.cache.key(self.config.wallabag_host, article_id, format, updated_at)
+            cached = await self.cache.get(key)
+            if cached is not None:
+                logger.debug(f"Use cached export of article {article_id} in format {format}")
+                with cached:
+                    yield cached
+                return
 
-    async def export_article(self, user: User, article_id: int, format: str) -> bytes | None:
-        params = self._api_params(user)
         url = self._url(f"/api/entries/{article_id}/export.{format}")
 
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, params=params) as resp:
+        started = time.monotonic()
+        async with contextlib.AsyncExitStack() as stack:
+            data: IO[bytes] | None = None
+            async with self._request("GET", user, url) as resp:
                 if resp.status != 200:
                     logger.error(
                         f"Cannot export article {article_id} of user {user.name} in format {format}", exc_info=True
                     )
-                    return None
+                else:
+                    size = resp.content_length or self._export_sizes.get(format, EXPORT_SIZE_ESTIMATE)
+                    reservation = None
+                    if self.budget is not None:
+                        reservation = await stack.enter_async_context(self.budget.reserve(size))
+                    data = stack.enter_context(
+                        tempfile.SpooledTemporaryFile(max_size=self.config.export_spool_size * 1024 * 1024)
+                    )
+                    async for chunk in resp.content.iter_chunked(EXPORT_CHUNK_SIZE):
+                        data.write(chunk)
+                        if reservation is not None and data.tell() > reservation.size:
+                            reservation.grow(data.tell() - reservation.size)
+                    self._export_sizes[format] = (3 * self._export_sizes.get(format, data.tell()) + data.tell()) // 4
+                    metrics.EXPORT_SIZE.observe(data.tell(), format)
+                    metrics.EXPORT_DURATION.observe(time.monotonic() - started, format)
+                    data.seek(0)
 
-                return await resp.read()
+            if data is not None and self.cache is not None and key is not None:
+                try:
+                    await self.cache.put(key, data)
+                except OSError:
+                    logger.exception(f"Cannot cache export of article {article_id} in format {format}")
+            yield data